@@ -2,5 +2,6 @@ from niix2bids import classes       # contains objects such as Volume
 from niix2bids import cli           # Command Line Inputs contains the parser (it's the entry point)
 from niix2bids import metadata      # some metadata, mostly for setup.py and the CLI help
 from niix2bids import utils         # utility functions for the workflow.run(), so "workflow" remains readable
-from niix2bids import workflow      # only contains the .run() function which is the <main> function
-from niix2bids import decision_tree # siemens decision tree
+from niix2bids import workflow      # only contains the .run*() functions which are the <main> functions
+from niix2bids import watch         # watch mode, convert new sessions as soon as they are ready
+from niix2bids.workflow import convert  # library entry point
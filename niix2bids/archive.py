@@ -0,0 +1,241 @@
+# standard modules
+import os                            # for path management
+import io                            # to read text members
+import re                            # regular expressions
+import time                          # to convert zip dates
+import shutil                        # to stream members
+import tarfile                       # .tar, .tar.gz, .tgz
+import zipfile                       # .zip
+import posixpath                     # member names always use /
+import functools                     # to cache the archive index
+import contextlib                    # for the open_file() context manager
+import sys                           # to write on stdout
+from typing import Dict, List, Tuple, NamedTuple  # for function signature
+
+# dependency modules
+
+# local modules
+
+
+# an archive member is addressed as /path/to/session.tar/member/path.nii, so the rest of the code sees a normal path
+archive_ext = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+
+########################################################################################################################
+class Stat(NamedTuple):
+    # same attribute names as os.stat_result, for the ones used by niix2bids
+    st_size    : int
+    st_atime_ns: int
+    st_mtime_ns: int
+
+
+########################################################################################################################
+def is_archive(path: str) -> bool:
+    return path.endswith(archive_ext) and os.path.isfile(path)
+
+
+########################################################################################################################
+def split_path(path: str) -> Tuple[str, str]:
+    # return (archive_path, member_name), or ('', path) for a normal file
+    for match in re.finditer(r'\.(tar|tar\.gz|tgz|zip)/', path):
+        archive_path = path[:match.end() - 1]
+        if os.path.isfile(archive_path):
+            return archive_path, path[match.end():]
+    return '', path
+
+
+########################################################################################################################
+@functools.lru_cache(maxsize=64)
+def _get_index(archive_path: str, size: int, mtime_ns: int) -> Dict[str, object]:
+    # size and mtime are only here so a modified archive is indexed again
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as zf:
+            return {posixpath.normpath(info.filename): info for info in zf.infolist() if not info.is_dir()}
+    else:
+        with tarfile.open(archive_path, 'r:*') as tf:
+            return {posixpath.normpath(info.name): info for info in tf if info.isfile()}
+
+
+########################################################################################################################
+def get_index(archive_path: str) -> Dict[str, object]:
+    # member name -> TarInfo or ZipInfo, only the headers are read
+    stat = os.stat(archive_path)
+    return _get_index(archive_path, stat.st_size, stat.st_mtime_ns)
+
+
+########################################################################################################################
+def list_files(archive_path: str) -> List[str]:
+    return [archive_path + '/' + name for name in get_index(archive_path)]
+
+
+########################################################################################################################
+def exists(path: str) -> bool:
+    archive_path, name = split_path(path)
+    if len(archive_path) == 0:
+        return os.path.exists(path)
+    return name in get_index(archive_path)
+
+
+########################################################################################################################
+def stat(path: str):
+    archive_path, name = split_path(path)
+    if len(archive_path) == 0:
+        return os.stat(path)
+    info = get_index(archive_path)[name]
+    if isinstance(info, zipfile.ZipInfo):
+        mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+        return Stat(info.file_size, mtime_ns, mtime_ns)
+    else:
+        mtime_ns = int(info.mtime) * 10**9
+        return Stat(info.size, mtime_ns, mtime_ns)
+
+
+########################################################################################################################
+@contextlib.contextmanager
+def open_file(path: str, mode: str = 'r'):
+    # same as open(), but also works for archive members (read only)
+
+    archive_path, name = split_path(path)
+    if len(archive_path) == 0:
+        with open(path, mode) as fp:
+            yield fp
+        return
+
+    info = get_index(archive_path)[name]
+    if isinstance(info, zipfile.ZipInfo):
+        with zipfile.ZipFile(archive_path) as zf, zf.open(info) as fp:
+            yield fp if 'b' in mode else io.TextIOWrapper(fp)
+    else:
+        with tarfile.open(archive_path, 'r:*') as tf, tf.extractfile(info) as fp:  # seek to the member, no new scan
+            yield fp if 'b' in mode else io.TextIOWrapper(fp)
+
+
+########################################################################################################################
+def iter_members(archive_path: str, names: set):
+    """
+    Yield (name, binary file object) for the wanted members, in the order of the archive.
+    The archive is read once, sequentially : for .tar.gz, this avoids decompressing the stream again for each member.
+    Each file object must be consumed before the next iteration.
+    """
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                name = posixpath.normpath(info.filename)
+                if name in names:
+                    with zf.open(info) as fp:
+                        yield name, fp
+    else:
+        with tarfile.open(archive_path, 'r|*') as tf:  # stream mode : no seek, one pass
+            for info in tf:
+                name = posixpath.normpath(info.name)
+                if info.isfile() and name in names:
+                    with tf.extractfile(info) as fp:
+                        yield name, fp
+
+
+########################################################################################################################
+def get_tmp_path(out_path: str) -> str:
+    # files are written under this hidden name, then renamed : out_path is either absent or complete, never truncated
+    dir_path, name = os.path.split(out_path)
+    return os.path.join(dir_path, f".{name}.niix2bids_tmp")
+
+
+########################################################################################################################
+def copy_members(archive_path: str, members: Dict[str, str], on_done=None) -> int:
+    # members : name -> out_path. Stream each member to its destination, without temporary extraction
+    # on_done : function(in_path, out_path, size), called after each member
+    written = 0
+    for name, fp in iter_members(archive_path, set(members.keys())):
+        out_path = members[name]
+        tmp_path = get_tmp_path(out_path)
+        with open(tmp_path, 'wb') as fp_out:
+            shutil.copyfileobj(fp, fp_out, 1024 * 1024)
+        member_stat = stat(archive_path + '/' + name)
+        os.utime(tmp_path, ns=(member_stat.st_atime_ns, member_stat.st_mtime_ns))  # keep mtime, for --update
+        os.replace(tmp_path, out_path)
+        written += member_stat.st_size
+        if on_done is not None:
+            on_done(archive_path + '/' + name, out_path, member_stat.st_size)
+    return written
+
+
+########################################################################################################################
+class TarWriter:
+    """
+    Output backend : the BIDS tree is written as one tar stream (file, or stdout with '-'), instead of files in out_dir.
+    Entries are only listed when added, then written by close(), grouped by directory.
+    Payloads are streamed from their source, so only the small synthesized texts are kept in memory.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, tar_path: str, out_dir: str):
+
+        # instance filling
+        self.tar_path = tar_path
+        self.out_dir  = out_dir
+        self.entries  = {}  # relative path -> (kind, source) with kind in 'file', 'symlink', 'text'
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def get_name(self, out_path: str) -> str:
+        return os.path.relpath(out_path, self.out_dir).replace(os.sep, '/')
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add_file(self, out_path: str, in_path: str) -> None:
+        self.entries.setdefault(self.get_name(out_path), ('file', in_path))  # the first one wins, as on disk
+
+    def add_symlink(self, out_path: str, in_path: str) -> None:
+        self.entries.setdefault(self.get_name(out_path), ('symlink', in_path))
+
+    def add_text(self, out_path: str, content: str) -> None:
+        self.entries.setdefault(self.get_name(out_path), ('text', content.encode()))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self) -> int:
+
+        # '.gz' or '.tgz' : compressed stream
+        mode = 'w|gz' if self.tar_path.endswith(('.gz', '.tgz')) else 'w|'
+        fileobj = sys.stdout.buffer if self.tar_path == '-' else open(self.tar_path, 'wb')
+
+        now = int(time.time())
+        written = 0
+        try:
+            with tarfile.open(fileobj=fileobj, mode=mode, format=tarfile.PAX_FORMAT) as tf:
+
+                # all entries of a directory are contiguous, and each directory comes before its content
+                dirs_done = {'.'}
+                for name in sorted(self.entries, key=lambda name: (posixpath.dirname(name).split('/'), name)):
+                    kind, source = self.entries[name]
+
+                    missing = []
+                    parent = posixpath.dirname(name) or '.'
+                    while parent not in dirs_done:
+                        missing.append(parent)
+                        parent = posixpath.dirname(parent) or '.'
+                    for dir_name in reversed(missing):
+                        info = tarfile.TarInfo(dir_name)
+                        info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, now
+                        tf.addfile(info)
+                        dirs_done.add(dir_name)
+
+                    info = tarfile.TarInfo(name)
+                    info.mode = 0o644
+                    if kind == 'symlink':
+                        info.type, info.linkname, info.mode, info.mtime = tarfile.SYMTYPE, source, 0o777, now
+                        tf.addfile(info)
+                    elif kind == 'text':
+                        info.size, info.mtime = len(source), now
+                        tf.addfile(info, io.BytesIO(source))
+                    else:
+                        source_stat = stat(source)
+                        info.size, info.mtime = source_stat.st_size, source_stat.st_mtime_ns // 10**9
+                        with open_file(source, 'rb') as fp:  # tarfile copies by blocks, the file is not loaded
+                            tf.addfile(info, fp)
+                    written += info.size
+
+        finally:
+            if fileobj is sys.stdout.buffer:
+                fileobj.flush()
+            else:
+                fileobj.close()
+
+        return written
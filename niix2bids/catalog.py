@@ -0,0 +1,255 @@
+# standard modules
+import os                    # for path management
+import json                  # nested sidecar values are stored as json text
+import glob                  # to find shard catalogs
+import re                    # to parse shard catalog names
+from typing import List      # for function signature
+
+# dependency modules
+import numpy as np           # the list cells of a parquet file are read as arrays
+import pandas as pd          # for DataFrame, and the parquet read/write
+
+# local modules
+from niix2bids import archive
+from niix2bids.classes import Volume, Niix2bidsError
+from niix2bids.utils import get_logger, get_volume_assignment, get_shard_name, get_catalog_file
+
+
+# 1 row per volume, identified by the source nifti
+key_column = 'in_path'
+
+# pandas dtype -> kind of its values, as get_kind()
+dtype_kinds = {'boolean': 'bool', 'Int64': 'int', 'float64': 'float', 'str': 'str'}
+
+
+########################################################################################################################
+def get_shard_catalog_file(out_dir: str, shard: tuple) -> str:
+    return get_catalog_file(out_dir, f"_{get_shard_name(shard)}")
+
+
+########################################################################################################################
+def check_engine() -> None:
+    # pyarrow is an optional dependency : fail before the conversion, not after
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        msg = "the catalog needs pyarrow : pip install niix2bids[catalog]"
+        get_logger().error(msg)
+        raise Niix2bidsError(msg)
+
+
+########################################################################################################################
+def get_row(out_dir: str, vol: Volume, transcode: str = None) -> dict:
+    # classification first, then all the sidecar fields
+    row = get_volume_assignment(out_dir, vol, transcode)
+    entities = row.pop('bidsfields')
+    row['entities'] = '_'.join(f"{key}-{value}" for key, value in entities.items())  # such as acq-mprage_run-1
+    for key, value in entities.items():
+        row[f"entity_{key}"] = str(value)
+    for key, value in vol.seqparam.items():
+        if key != 'Volume':
+            row.setdefault(key, value)
+    return row
+
+
+########################################################################################################################
+def get_kind(value) -> str:
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    if isinstance(value, (list, tuple)):
+        if all(isinstance(item, str) for item in value):
+            return 'str_list'
+        if all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in value):
+            return 'float_list'
+    return 'json'
+
+
+########################################################################################################################
+def make_column(values: list, kinds: set = None) -> pd.Series:
+    # parquet needs 1 type per column : the sidecars do not always agree, such as 2 and 2.5, or 'A' and ['A', 'B']
+    # kinds : of the whole column, when values are only a part of it, such as 1 chunk
+    if kinds is None:
+        kinds = {get_kind(value) for value in values if value is not None}
+    if kinds == {'bool'}:
+        return pd.Series(values, dtype='boolean')
+    if kinds == {'int'}:
+        return pd.Series(values, dtype='Int64')
+    if kinds <= {'int', 'float'}:
+        return pd.Series([None if value is None else float(value) for value in values], dtype='float64')
+    if kinds == {'str'}:
+        return pd.Series(values, dtype='str')
+    if kinds == {'str_list'}:
+        return pd.Series([None if value is None else list(value) for value in values], dtype=object)
+    if kinds == {'float_list'}:
+        return pd.Series([None if value is None else [float(item) for item in value] for value in values],
+                         dtype=object)
+    # mixed : text, as written in the .json
+    return pd.Series([value if value is None or isinstance(value, str) else json.dumps(value) for value in values],
+                     dtype=object)
+
+
+########################################################################################################################
+def make_frame(rows: List[dict]) -> pd.DataFrame:
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)  # first seen order : classification columns, then the sidecar fields
+    return pd.DataFrame({key: make_column([row.get(key) for row in rows]) for key in columns})
+
+
+########################################################################################################################
+def get_frame(out_dir: str, volumes: List[Volume], transcode: str = None, duplicates: list = ()) -> pd.DataFrame:
+    rows = [get_row(out_dir, vol, transcode) for vol in volumes]
+    for volume, canonical in duplicates:
+        row = get_row(out_dir, volume, transcode)
+        row['status'] = 'duplicate'
+        row['reason_not_ready'] = f"duplicate of {canonical.nii.path}"
+        rows.append(row)
+    return make_frame(rows)
+
+
+########################################################################################################################
+def get_value(value):
+    # DataFrame cell -> python value, as in the .json
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return value
+    return None if pd.isna(value) else value
+
+
+########################################################################################################################
+def get_part_file(path: str, index: int) -> str:
+    # 1 file per chunk, combined by write_catalog() : the frames of the previous chunks are not kept in memory
+    return archive.get_tmp_path(f"{path}.part-{index}")
+
+
+########################################################################################################################
+def write_part(path: str, out_dir: str, volumes: List[Volume], transcode: str = None, duplicates: list = ()) -> None:
+    get_frame(out_dir, volumes, transcode, duplicates).to_parquet(path, index=False)
+
+
+########################################################################################################################
+def get_column_kinds(column: pd.Series) -> set:
+    values = column.dropna()
+    if len(values) == 0:
+        return set()
+    if str(column.dtype) in dtype_kinds:
+        return {dtype_kinds[str(column.dtype)]}
+    return {get_kind(get_value(value)) for value in values.tolist()}
+
+
+########################################################################################################################
+def fit_column(df: pd.DataFrame, column: str, kinds: set) -> pd.Series:
+    # a field missing in this part, or with another type in another part, such as Int64 and float64 : typed again
+    if column not in df.columns:
+        return make_column([None] * len(df), kinds)
+    if str(df[column].dtype) != 'object' and get_column_kinds(df[column]) == kinds:
+        return df[column]
+    return make_column([get_value(value) for value in df[column].tolist()], kinds)
+
+
+########################################################################################################################
+def get_schema(columns: dict):
+    import pyarrow as pa  # optional dependency, checked by check_engine()
+
+    # the pandas dtypes are kept in the metadata, such as Int64 : the catalog is read back with the same types
+    df = pd.DataFrame({column: make_column([], kinds) for column, kinds in columns.items()})
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    # an empty object column has no type : lists, or text as written in the .json
+    for column, kinds in columns.items():
+        if str(df[column].dtype) == 'object':
+            if kinds == {'str_list'}:
+                arrow_type = pa.list_(pa.string())
+            elif kinds == {'float_list'}:
+                arrow_type = pa.list_(pa.float64())
+            else:
+                arrow_type = pa.string()
+            schema = schema.set(schema.get_field_index(column), pa.field(column, arrow_type))
+    return schema
+
+
+########################################################################################################################
+def iter_frames(sources: list, old, keys: set):
+    # 1 row group at a time : the rows of the existing catalog that are not replaced, then the parts
+    if old is not None:
+        for index in range(old.num_row_groups):
+            df = old.read_row_group(index).to_pandas()
+            yield df[~df[key_column].isin(keys)].reset_index(drop=True)
+    for source in sources:
+        for index in range(source.num_row_groups):
+            yield source.read_row_group(index).to_pandas()
+
+
+########################################################################################################################
+def write_catalog(path: str, parts: List[str], update: bool = False) -> int:
+    """
+    Write the catalog of the volumes of this run, 1 row per volume, from the parquet file of each chunk or shard.
+    The parts are read twice, 1 row group at a time : first for the type of each column, then to write it.
+    update : keep the rows of the existing catalog for the volumes that are not in this run, such as other subjects.
+             The whole catalog is read and written again : the memory stays bounded, but not the time of each update.
+    Return the number of rows.
+    """
+    import pyarrow as pa          # optional dependency, checked by check_engine()
+    import pyarrow.parquet as pq
+
+    log = get_logger()
+
+    sources = [pq.ParquetFile(part) for part in parts]
+    keys = set()
+    old = None
+    if update and os.path.exists(path):
+        try:
+            old = pq.ParquetFile(path)
+        except Exception as err:  # the parquet engine has its own exceptions
+            log.warning(f"cannot read the catalog, it is replaced by the volumes of this run : {path} : {err}")
+        else:
+            for source in sources:
+                keys.update(source.read(columns=[key_column]).column(key_column).to_pylist())
+
+    # 1st pass : the kinds of values of each column, in first seen order
+    columns = {}
+    for df in iter_frames(sources, old, keys):
+        for column in df.columns:
+            columns.setdefault(column, set()).update(get_column_kinds(df[column]))
+    if len(columns) == 0:
+        columns[key_column] = {'str'}
+
+    # 2nd pass : 1 row group per part
+    # written under a temporary name, then renamed : a reader never sees a partial file
+    schema = get_schema(columns)
+    tmp_path = archive.get_tmp_path(path)
+    nrow = 0
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for df in iter_frames(sources, old, keys):
+            if len(df) == 0:
+                continue
+            df = pd.DataFrame({column: fit_column(df, column, kinds) for column, kinds in columns.items()})
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            nrow += len(df)
+    os.replace(tmp_path, path)
+
+    log.info(f"catalog : {nrow} volumes, {len(columns)} columns -> {path}")
+    return nrow
+
+
+########################################################################################################################
+def merge_shard_catalogs(out_dir: str) -> None:
+
+    log = get_logger()
+
+    shard_catalog_list = glob.glob(get_catalog_file(out_dir, '_shard-*of*'))
+    if len(shard_catalog_list) == 0:
+        return  # the shards were run without catalog
+
+    r = re.compile(r".*niix2bids_catalog_shard-(\d+)of(\d+)\.parquet$")
+    shards = sorted([tuple(int(x) for x in r.match(file).groups()) for file in shard_catalog_list])
+    check_engine()
+    write_catalog(get_catalog_file(out_dir), [get_shard_catalog_file(out_dir, shard) for shard in shards])
+    log.info(f"merged {len(shards)} shard catalogs")
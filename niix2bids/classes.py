@@ -1,48 +1,111 @@
 import os    # for path management
 import json  # json file loading
+import re    # regular expressions
+import math  # to keep -0.0 apart from 0.0
+
+from niix2bids import archive
+
+########################################################################################################################
+class Niix2bidsError(Exception):
+    # raised instead of stopping the python process, so niix2bids can be used as a library
+    # the message is already logged when the error is raised
+    pass
+
 
 ########################################################################################################################
 class File:
-    instances = []
 
     def __init__(self, path: str):
 
         # instance filling
         self.path = path
 
-        # store a list of all instances
-        self.__class__.instances.append(self)  # add in a class variable all instances of the class, for easy retrieve
-
     def __repr__(self):
         return f"<{__name__}.{self.__class__.__name__}: path = {self.path}>"
 
+    def open(self, mode: str = 'r'):
+        # context manager, the file can also be a member of a .tar or .zip
+        return archive.open_file(self.path, mode)
+
 
 ########################################################################################################################
 class Nii(File):
-    instances = []
+
+    def __init__(self, path: str, header_cache=None):
+        super().__init__(path)
+
+        # instance filling
+        self.head         = None          # first bytes of the uncompressed header, when read together with the .json
+        self.header_cache = header_cache  # HeaderCache of the run, None : the header is always read
 
 
 ########################################################################################################################
 class Json(File):
-    instances = []
+    pass
 
 
 ########################################################################################################################
 class Bval(File):
-    instances = []
+    pass
 
 
 ########################################################################################################################
 class Bvec(File):
-    instances = []
+    pass
+
+
+########################################################################################################################
+scalar_types = frozenset([str, int, float, bool])  # .json arrays of these are shared as tuples
+
+
+########################################################################################################################
+class SidecarPool:
+    """
+    Shared storage of the .json values : across a cohort, most of them are repeated verbatim (Manufacturer,
+    PulseSequenceDetails, ProtocolName, ImageType, SliceTiming, ...), so each distinct value is only kept once.
+    Strings, keys included, are shared. Arrays of str/numbers become tuples, so they can be shared safely :
+    json.dumps() writes them back as lists.
+    Usage : json.loads(content, object_pairs_hook=pool.make_dict)
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self):
+
+        # instance filling
+        self.values = {}  # value -> the same value, shared by all the sidecars
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def share(self, value):
+        kind = type(value)
+        if kind is str:
+            return self.values.setdefault(value, value)
+        if kind is not list:
+            return value  # numbers, bool, None : small, and mostly cached by python
+
+        types = frozenset(map(type, value))
+        if not types <= scalar_types:
+            return [self.share(item) for item in value]  # nested arrays or objects : not shared
+        items = tuple(map(self.share, value)) if str in types else tuple(value)
+        if float in types and 0. in items and any(math.copysign(1, item) < 0 for item in items if item == 0):
+            return value  # -0.0 == 0.0, but json.dumps() would not write the same text
+        # 1 == 1.0 == True : the types are part of the key, so [1, 2] and [1.0, 2.0] are not mixed
+        key = (types, items) if len(types) <= 1 else (tuple(map(type, items)), items)
+        return self.values.setdefault(key, items)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def make_dict(self, pairs: list) -> dict:
+        # called for each .json object : the str case of share() is inlined, it is most of the values
+        values = self.values
+        return {values.setdefault(key, key):
+                values.setdefault(value, value) if type(value) is str else self.share(value)
+                for key, value in pairs}
 
 
 ########################################################################################################################
 class Volume:
-    instances = []
 
     # ------------------------------------------------------------------------------------------------------------------
-    def __init__(self, niipath: str):
+    def __init__(self, niipath: str, header_cache=None):
 
         # separate name and extension
         root, ext = os.path.splitext(niipath)
@@ -60,7 +123,7 @@ class Volume:
         # instance filling
         self.basename         = basename       # /path/to/volume
         self.ext              = ext            # .nii OR .nii.gz
-        self.nii              = Nii(niipath)
+        self.nii              = Nii(niipath, header_cache)
         self.json             = Json(jsonfile)
         self.seqparam         = dict           # content of the .json file, from dcm2niix
         self.reason_not_ready = ''             # if ready==False, this is the message that will be displayed
@@ -69,17 +132,44 @@ class Volume:
         self.sub              = ''             # subject name, such as sub-<>
         self.ses              = ''             # session number, such as sess-<>
         self.suffix           = ''             # suffix, such as T1w, bold, sbref
+        self.collision        = ''             # in_path of the volume that already has the same destination
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def load_json(self, content: str = None, pool: SidecarPool = None):
+        if content is None:  # archive members are read in one pass by read_all_json(), then given here
+            with self.json.open("r") as file:
+                content = file.read()
+        clean = content.replace(r'\\', r'_')  # in ~2021, dcm2iix escaping character changed from _ to \\
+        hook = pool.make_dict if pool is not None else None
+        self.seqparam = json.loads(clean, object_pairs_hook=hook)  # load the .json content as dict
+        self.seqparam['Volume'] = self        # save also in the dict a pointer to the object itself
 
-        # store a list of all instances
-        self.__class__.instances.append(self)
+    # ------------------------------------------------------------------------------------------------------------------
+    def reset_bids(self):
+        # forget the results of the decision tree, so the volume can be classified again
+        self.reason_not_ready = ''
+        self.bidsfields       = {}
+        self.tag              = ''
+        self.sub              = ''
+        self.ses              = ''
+        self.suffix           = ''
+        self.collision        = ''
 
     # ------------------------------------------------------------------------------------------------------------------
-    def load_json(self):
-        with open(self.json.path, "r") as file:
-            content = file.read()
-            clean = content.replace(r'\\', r'_')  # in ~2021, dcm2iix escaping character changed from _ to \\
-            self.seqparam = json.loads(clean)     # load the .json content as dict
-            self.seqparam['Volume'] = self        # save also in the dict a pointer to the object itself
+    def peek_json(self, key: str, head_size: int = 4096):
+        # cheap extraction of one top-level string field, without parsing the whole .json
+        # dcm2niix writes the "identity" fields (PatientName, ...) at the top of the file, so the head is usually enough
+        r = re.compile(r'"' + re.escape(key) + r'"\s*:\s*("(?:[^"\\]|\\.)*")')
+        with self.json.open("r") as file:
+            content = file.read(head_size)
+            match = r.search(content)
+            if match is None and len(content) == head_size:
+                content += file.read()
+                match = r.search(content)
+        if match is None:
+            return None
+        clean = match.group(1).replace(r'\\', r'_')  # same cleaning as in load_json()
+        return json.loads(clean)
 
     # ------------------------------------------------------------------------------------------------------------------
     def __repr__(self):
@@ -92,7 +182,7 @@ class Volume:
             bval_file = os.path.splitext(root)[0] + ".bval"
         else:
             bval_file = os.path.splitext(self.nii.path)[0] + ".bval"
-        if not os.path.exists(bval_file):
+        if not archive.exists(bval_file):
             return False
         else:
             self.bval = Bval(bval_file)
@@ -105,7 +195,7 @@ class Volume:
             bvec_file = os.path.splitext(root)[0] + ".bvec"
         else:
             bvec_file = os.path.splitext(self.nii.path)[0] + ".bvec"
-        if not os.path.exists(bvec_file):
+        if not archive.exists(bvec_file):
             return False
         else:
             self.bvec = Bvec(bvec_file)
@@ -117,3 +207,20 @@ class Volume:
 
     def __gt__(self, other):
         return self.__repr__() > other.__repr__()
+
+
+########################################################################################################################
+class ConversionResult:
+
+    def __init__(self, out_dir: str):
+
+        # instance filling
+        self.out_dir     = out_dir
+        self.volumes     = []  # List[Volume], all volumes with a readable .json
+        self.assignments = []  # List[dict], 1 per volume : where it went and why
+        self.timings     = {}  # stage name -> execution time in seconds
+        self.report_file = ''  # .tsv, 1 row per volume
+        self.duplicates  = []  # List[Tuple[Volume, Volume]], (removed duplicate, canonical copy)
+
+    def __repr__(self):
+        return f"<{__name__}.{self.__class__.__name__}: out_dir = {self.out_dir}, {len(self.volumes)} volumes>"
@@ -1,12 +1,14 @@
 # standard modules
 import argparse  # parser of the CLI
 import os        # for path management
+import re        # regular expressions
+import sys       # to get the command line
 
 # dependency modules
 
 # local modules
 import niix2bids
-from niix2bids import metadata
+from niix2bids import metadata, dicom
 
 
 ########################################################################################################################
@@ -24,37 +26,33 @@ def format_args(args: argparse.Namespace) -> argparse.Namespace:
 
 
 ########################################################################################################################
-def get_parser() -> argparse.ArgumentParser:
+def parse_shard(shard: str) -> tuple:
+    match = re.match(r'^(\d+)/(\d+)$', shard)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"shard must be INDEX/COUNT, such as 1/4 : {shard}")
+    shard_index, shard_count = int(match.group(1)), int(match.group(2))
+    if not 1 <= shard_index <= shard_count:
+        raise argparse.ArgumentTypeError(f"shard INDEX must be in [1, COUNT] : {shard}")
+    return shard_index, shard_count
 
-    niix2bids_version = metadata.get_niix2bids_version()
-    bids_version = metadata.get_bids_version()
 
-    description = """
-    Create BIDS architecture from nifti files and .json sidecars.
-    This method expects DICOM converted by dcm2niix (https://github.com/rordenlab/dcm2niix)
-    """
-
-    epilog = f"niix2bids_version=={niix2bids_version} + bids_version=={bids_version}"
-
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(prog='niix2bids',
-                                     description=description,
-                                     epilog=epilog,
-                                     formatter_class=argparse.RawTextHelpFormatter)
+########################################################################################################################
+def parse_size(size: str) -> int:
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', size.upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"size must be a number with an optional K/M/G/T unit, such as 8G : {size}")
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' '))
 
-    # This is a strategy found on stackoverflow to separate 'Required arguments' and 'Optional arguments'
-    # in a way --help display looks more readable
-    optional = parser._action_groups.pop()  # extract optional arguments
-    optional.title = "Optional arguments"
 
-    # and now we add 'Required arguments'
-    required = parser.add_argument_group("Required arguments")
+########################################################################################################################
+def add_common_arguments(required: argparse._ArgumentGroup, optional: argparse._ArgumentGroup) -> None:
 
     required.add_argument("-i", "--in_dir",
                           help=(
                               "Nifti directories that will be parsed and transformed into BIDS architecture.\n"
                               "This directory is usually the output directory of dcm2niix.\n"
-                              "This argument accepts several paths. You can use syntax such as /path/to/nii/2021_*"
+                              "This argument accepts several paths. You can use syntax such as /path/to/nii/2021_*\n"
+                              "Archives (.tar, .tar.gz, .tgz, .zip) are read directly, without extraction."
                           ),
                           nargs='+',
                           metavar='DIR',
@@ -98,12 +96,241 @@ def get_parser() -> argparse.ArgumentParser:
                           ),
                           dest="config_file",
                           metavar='FILE',
-                          default=[
-                              os.path.join( os.path.expanduser('~'), 'niix2bids_config_file', 'siemens.py'),
-                              os.path.join( niix2bids.__path__[0], 'config_file', 'siemens.py')
-                          ]
+                          default=niix2bids.utils.get_default_config_file()
                           )
 
+    optional.add_argument("--catalog",
+                          help=(
+                              "Write out_dir/niix2bids_catalog.parquet : 1 row per volume, with all the sidecar fields\n"
+                              "and the classification (tag, suffix, entities, out_path, status), for cohort queries.\n"
+                              "Needs pyarrow : pip install niix2bids[catalog]"
+                          ),
+                          dest="catalog",
+                          action="store_true")
+
+    optional.add_argument("--progress",
+                          help=(
+                              "Progress of the long stages (files found, .json read, files written), with ETA\n"
+                              "log : log lines (default), tty : 1 line on stderr, rewritten in place, none : disabled"
+                          ),
+                          dest="progress",
+                          choices=['log', 'tty', 'none'],
+                          default='log')
+    optional.add_argument("--progress-interval",
+                          help=(
+                              "Seconds between 2 progress events of a stage (default: %(default)s).\n"
+                              "Stages shorter than that print nothing"
+                          ),
+                          dest="progress_interval",
+                          metavar='SEC',
+                          type=float,
+                          default=10.)
+
+
+########################################################################################################################
+def get_parser() -> argparse.ArgumentParser:
+
+    niix2bids_version = metadata.get_niix2bids_version()
+    bids_version = metadata.get_bids_version()
+
+    description = """
+    Create BIDS architecture from nifti files and .json sidecars.
+    This method expects DICOM converted by dcm2niix (https://github.com/rordenlab/dcm2niix)
+    """
+
+    epilog = f"niix2bids_version=={niix2bids_version} + bids_version=={bids_version}"
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(prog='niix2bids',
+                                     description=description,
+                                     epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    # This is a strategy found on stackoverflow to separate 'Required arguments' and 'Optional arguments'
+    # in a way --help display looks more readable
+    optional = parser._action_groups.pop()  # extract optional arguments
+    optional.title = "Optional arguments"
+
+    # and now we add 'Required arguments'
+    required = parser.add_argument_group("Required arguments")
+
+    add_common_arguments(required, optional)
+
+    optional.add_argument("--from-dicom",
+                          help=(
+                              "in_dir contains DICOM series : convert them first with dcm2niix, in parallel.\n"
+                              "Nifti written in out_dir/sourcedata/dcm2niix/<in_dir name>_<path hash>, with its tree.\n"
+                              "A series already converted by a previous run is not converted again"
+                          ),
+                          dest="from_dicom",
+                          action="store_true")
+    optional.add_argument("--dcm2niix",
+                          help="dcm2niix executable, name on PATH or path (default: %(default)s)",
+                          dest="dcm2niix",
+                          metavar='EXE',
+                          default='dcm2niix')
+    optional.add_argument("--dcm2niix-flags",
+                          help=(
+                              "dcm2niix options, without -o (default: '%(default)s').\n"
+                              "'-ba n' is added if missing : PatientName is needed"
+                          ),
+                          dest="dcm2niix_flags",
+                          metavar='FLAGS',
+                          default=dicom.default_flags)
+    optional.add_argument("--dcm2niix-jobs",
+                          help="Number of dcm2niix running at a time (default: number of CPUs)",
+                          dest="dcm2niix_jobs",
+                          metavar='N',
+                          type=int,
+                          default=None)
+
+    optional.add_argument("--include-subject",
+                          help=(
+                              "Only process the subjects matching PATTERN, repeatable. Shell-style pattern, such as\n"
+                              "'SUBJ01', 'sub-SUBJ0*' or 'PAT_[0-9]*', tested on PatientName and on its BIDS name.\n"
+                              "The other subjects are dropped before the .json are loaded"
+                          ),
+                          dest="include_subject",
+                          metavar='PATTERN',
+                          action="append",
+                          default=None)
+    optional.add_argument("--exclude-subject",
+                          help="Do not process the subjects matching PATTERN, repeatable. Same patterns as above",
+                          dest="exclude_subject",
+                          metavar='PATTERN',
+                          action="append",
+                          default=None)
+    optional.add_argument("--subject-dirs",
+                          help=(
+                              "The directories directly in in_dir are named after the subjects : the subject\n"
+                              "patterns are tested on these names, and the other directories are not explored"
+                          ),
+                          dest="subject_dirs",
+                          action="store_true")
+    optional.add_argument("--include-session",
+                          help=(
+                              "Only write the sessions matching PATTERN, repeatable : session number ('2', 'ses-2')\n"
+                              "or StudyInstanceUID. The session numbers stay the same as in a full run.\n"
+                              "With any subject or session filter, the report is niix2bids_report_subset.tsv"
+                          ),
+                          dest="include_session",
+                          metavar='PATTERN',
+                          action="append",
+                          default=None)
+
+    optional.add_argument("--shard",
+                          help=(
+                              "Only process the subjects of shard INDEX (from 1 to COUNT), for multi-node runs.\n"
+                              "Each PatientName is assigned to a shard using a stable hash.\n"
+                              "dataset_description.json, README, ... are not written : when all shards are done,\n"
+                              "run 'niix2bids merge -o DIR' once to write them and combine the shard reports."
+                          ),
+                          dest="shard",
+                          metavar='INDEX/COUNT',
+                          type=parse_shard,
+                          default=None)
+
+    optional.add_argument("--update",
+                          help=(
+                              "Files already in out_dir are compared with their source, instead of being skipped.\n"
+                              "Only the changed ones are written again : different size or mtime for --copyfile,\n"
+                              "different target for --symlink, different content for the modified .json"
+                          ),
+                          dest="update",
+                          action="store_true")
+    optional.add_argument("--checksum",
+                          help=(
+                              "Implies --update. With --copyfile, files with the same size but a different mtime\n"
+                              "are compared with a content hash, instead of being copied again"
+                          ),
+                          dest="checksum",
+                          action="store_true")
+
+    exclus_3 = optional.add_mutually_exclusive_group()
+    exclus_3.add_argument("--compress",
+                          help=(
+                              "Write all nifti as .nii.gz : uncompressed .nii sources are compressed (not symlinked).\n"
+                              "Files are transcoded in parallel, by chunks"
+                          ),
+                          dest="transcode",
+                          action="store_const",
+                          const="compress")
+    exclus_3.add_argument("--decompress",
+                          help="Write all nifti as .nii, for tools that memory-map them : .nii.gz sources are decompressed",
+                          dest="transcode",
+                          action="store_const",
+                          const="decompress")
+    exclus_3.set_defaults(transcode=None)
+    optional.add_argument("--compress-level",
+                          help="zlib level used by --compress, from 1 (fast) to 9 (small) (default: %(default)s)",
+                          dest="compress_level",
+                          metavar='LEVEL',
+                          type=int,
+                          choices=range(1, 10),
+                          default=6)
+
+    optional.add_argument("--out-tar",
+                          help=(
+                              "Write the BIDS tree in one tar stream instead of files in out_dir, '-' for stdout.\n"
+                              "FILE ending with .gz or .tgz is compressed. out_dir still receives the logs and the report.\n"
+                              "With --symlink, the tar contains symlinks to the source files.\n"
+                              "Not compatible with --update, --checksum, --compress, --decompress"
+                          ),
+                          dest="out_tar",
+                          metavar='FILE',
+                          default=None)
+
+    optional.add_argument("--keep-duplicates",
+                          help=(
+                              "Do not remove duplicate series. By default, nifti with the same SeriesInstanceUID,\n"
+                              "AcquisitionTime, EchoNumber, ImageType and the same content are only written once"
+                          ),
+                          dest="keep_duplicates",
+                          action="store_true")
+
+    optional.add_argument("--chunk-subjects",
+                          help=(
+                              "Load, classify and write N subjects at a time, then release them, for big cohorts.\n"
+                              "Subjects are found with a first quick read of PatientName"
+                          ),
+                          dest="chunk_subjects",
+                          metavar='N',
+                          type=int,
+                          default=None)
+    optional.add_argument("--max-memory",
+                          help=(
+                              "Same as --chunk-subjects, but the chunks are built to need about SIZE of memory,\n"
+                              "estimated from the size of the .json files. For example 4G"
+                          ),
+                          dest="max_memory",
+                          metavar='SIZE',
+                          type=parse_size,
+                          default=None)
+
+    exclus_4 = optional.add_mutually_exclusive_group()
+    exclus_4.add_argument("--header-cache",
+                          help=(
+                              "Nifti header cache (shape, voxel sizes, datatype), reused by the next runs while the\n"
+                              "files keep the same size and mtime. Default : out_dir/niix2bids_header_cache.sqlite"
+                          ),
+                          dest="header_cache",
+                          metavar='FILE')
+    exclus_4.add_argument("--no-header-cache",
+                          help="Always read the nifti headers",
+                          dest="header_cache",
+                          action="store_false")
+    exclus_4.set_defaults(header_cache=True)
+
+    optional.add_argument("--profile",
+                          help=(
+                              "Profile each stage and each decision tree program, results in out_dir/niix2bids_profile\n"
+                              "cpu : 1 cProfile .pstats file per stage\n"
+                              "memory : tracemalloc peak and top allocation sites per stage, in memory.txt"
+                          ),
+                          dest="profile",
+                          choices=['cpu', 'memory'],
+                          default=None)
+
     optional.add_argument("-v", "--version",
                           action="version",
                           version=niix2bids_version)
@@ -113,20 +340,158 @@ def get_parser() -> argparse.ArgumentParser:
     return parser
 
 
+########################################################################################################################
+def get_watch_parser() -> argparse.ArgumentParser:
+
+    niix2bids_version = metadata.get_niix2bids_version()
+    bids_version = metadata.get_bids_version()
+
+    description = """
+    Watch mode : poll in_dir, and convert each new session as soon as dcm2niix is done with it.
+    A session is a directory of nifti files and .json sidecars. It is "ready" when its files stopped changing.
+    """
+
+    epilog = f"niix2bids_version=={niix2bids_version} + bids_version=={bids_version}"
+
+    parser = argparse.ArgumentParser(prog='niix2bids watch',
+                                     description=description,
+                                     epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    optional = parser._action_groups.pop()  # extract optional arguments
+    optional.title = "Optional arguments"
+
+    required = parser.add_argument_group("Required arguments")
+
+    add_common_arguments(required, optional)
+
+    optional.add_argument("--interval",
+                          help="Polling interval, in seconds (default: %(default)s)",
+                          metavar='SEC',
+                          type=float,
+                          default=10.)
+
+    optional.add_argument("--quiescence",
+                          help="A session is converted when its files did not change during SEC seconds (default: %(default)s)",
+                          metavar='SEC',
+                          type=float,
+                          default=60.)
+
+    parser._action_groups.append(optional)  # this trick is just so the --help option appears correctly
+
+    return parser
+
+
+########################################################################################################################
+def get_merge_parser() -> argparse.ArgumentParser:
+
+    niix2bids_version = metadata.get_niix2bids_version()
+    bids_version = metadata.get_bids_version()
+
+    description = """
+    Merge step, after all 'niix2bids --shard INDEX/COUNT' jobs are done.
+    Write dataset_description.json, README, CHANGES, LICENSE, .bidsignore and combine the shard reports.
+    """
+
+    epilog = f"niix2bids_version=={niix2bids_version} + bids_version=={bids_version}"
+
+    parser = argparse.ArgumentParser(prog='niix2bids merge',
+                                     description=description,
+                                     epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    optional = parser._action_groups.pop()  # extract optional arguments
+    optional.title = "Optional arguments"
+
+    required = parser.add_argument_group("Required arguments")
+
+    required.add_argument("-o", "--out_dir",
+                          help="Output directory, the same as the one used by all shards.",
+                          metavar='DIR',
+                          required=True)
+
+    exclus_2 = optional.add_mutually_exclusive_group()
+    exclus_2.add_argument("--logfile",
+                          help="Write logfile (default)",
+                          dest="logfile",
+                          action="store_true")
+    exclus_2.add_argument("--no-logfile",
+                          help="Disable writing logfile",
+                          dest="logfile",
+                          action="store_false")
+    exclus_2.set_defaults(logfile=True)
+
+    parser._action_groups.append(optional)  # this trick is just so the --help option appears correctly
+
+    return parser
+
+
 ########################################################################################################################
 def main() -> None:
 
+    # sub-command ?
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        main_merge(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        main_watch(sys.argv[2:])
+        return
+
     # Parse inputs
     parser = get_parser()       # Fetch my parser
     args = parser.parse_args()  # Parse
     args = format_args(args)    # Format args
+    if args.out_tar is not None and (args.update or args.checksum or args.transcode is not None):
+        parser.error("--out-tar is not compatible with --update, --checksum, --compress, --decompress")
+    if args.from_dicom and args.shard is not None:
+        parser.error("--from-dicom is not compatible with --shard")
 
     # create output dir id needed
     if not os.path.exists(args.out_dir):
         os.makedirs(args.out_dir)
 
     # initialize logger (console & file)
-    niix2bids.utils.init_logger(args.logfile, args.out_dir)
+    if args.shard is not None:
+        logfile_suffix = '_' + niix2bids.utils.get_shard_name(args.shard)  # shards may start at the same second
+    else:
+        logfile_suffix = ''
+    niix2bids.utils.init_logger(args.logfile, args.out_dir, logfile_suffix=logfile_suffix,
+                                console_stderr=args.out_tar == '-')  # stdout receives the tar
 
     # Call workflow
     niix2bids.workflow.run(args)
+
+
+########################################################################################################################
+def main_watch(argv: list) -> None:
+
+    # Parse inputs
+    parser = get_watch_parser()
+    args = parser.parse_args(argv)
+    args = format_args(args)
+
+    # create output dir id needed
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    # initialize logger (console & file)
+    niix2bids.utils.init_logger(args.logfile, args.out_dir, logfile_suffix='_watch')
+
+    # Call workflow
+    niix2bids.workflow.run_watch(args)
+
+
+########################################################################################################################
+def main_merge(argv: list) -> None:
+
+    # Parse inputs
+    parser = get_merge_parser()
+    args = parser.parse_args(argv)
+    args.out_dir = os.path.abspath(args.out_dir)
+    args.logfile = args.logfile and os.path.exists(args.out_dir)  # do not create out_dir, it must come from the shards
+
+    # initialize logger (console & file)
+    niix2bids.utils.init_logger(args.logfile, args.out_dir, logfile_suffix='_merge')
+
+    # Call workflow
+    niix2bids.workflow.run_merge(args)
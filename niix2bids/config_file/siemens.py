@@ -1,4 +1,6 @@
 # the approach is simple : the sequence name ('gre') defines which decision tree to apply
+# the decision tree is a program name, such as 'prog_gre', or a program written here as a dict
+# see niix2bids.decision_tree.rules for the format, and niix2bids.decision_tree.siemens for the built-in programs
 product = [
     # [seq_regex             fcn name]
     ['^tfl$'                       , 'prog_mprage' ],  # mprage & mp2rage
@@ -29,5 +31,14 @@ c2p = [
     ["dkd_tfl_brp"                 , "prog_mprage" ],  # mprage like
 ]
 
+# example of a new sequence, without python code : 2D T1w images of an 'icm_se' sequence
+# custom = [
+#     ['^icm_se$', {'ndim' : '2D',
+#                   'rules': [{'group'   : ['SeriesDescription', 'ImageTypeStr'],
+#                              'tag'     : 'anat',
+#                              'suffix'  : 'T1w',
+#                              'entities': {'acq': '{ProtocolName|clean}', 'run': '{run}'}}]}],
+# ]
+
 # the "output" variable has to be called "config"
 config = product + wip + c2p
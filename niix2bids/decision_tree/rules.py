@@ -0,0 +1,322 @@
+"""
+Declarative decision tree : a program is a dict, evaluated with DataFrame masks and groups.
+
+    {
+        'ndim' : '3D',                             # MRAcquisitionType, other rows get a "non-3D acquisition" reason
+        'match': {'ImageTypeKind': '^(M|P)$'},     # rows of the program, the others are left untouched
+        'rules': [rule, rule, ...],                # applied in order, on the rows of the program
+    }
+
+A rule selects rows, builds groups, and sets the Volume attributes :
+
+    {
+        'match'   : {'SeriesDescription': '.*_SBRef$'},  # column -> regex (str.match), '!regex' for "does not match"
+        'fill'    : {'EchoNumber': -1},                  # NaN (or missing column) -> value, before 'where' and 'group'
+        'where'   : 'EchoNumber > 0',                    # pandas expression, see DataFrame.eval()
+        'check'   : 'not_4D',                            # per volume test, see `checks` (it reads files)
+        'group'   : ['SeriesDescription', 'PhaseEncodingDirection'],  # run numbers are counted in each group
+        'tag'     : 'dwi',
+        'keep_tag': True,                                # do not overwrite a tag set by a previous rule
+        'suffix'  : 'sbref',
+        'entities': {'acq': '{ProtocolName|clean}', 'run': '{run}'},  # in the order of the BIDS name
+        'optional': ['echo'],                            # entities skipped when their value is ''
+        'reason'  : 'non-4D dwi volume',                 # reason_not_ready
+        'action'  : 'bval_bvec',                         # function of the volumes of the rule, see `actions`
+        'consume' : True,                                # the volumes of this rule are not seen by the next rules
+    }
+
+Templates are '{Column}' or '{Column|transform}', see `transforms`. '{run}' is the run number.
+A template that is only 1 field keeps the type of the value, such as int for the run number.
+With 'group', sub and ses are set, and templates are evaluated on the first row of each group, except 'reason' which
+is evaluated on each row. Groups are always per subject and per session.
+"""
+
+# standard modules
+import re                      # regular expressions
+import concurrent.futures      # to check the .bval and .bvec in parallel
+from typing import List, Dict  # for function signature
+
+# dependency modules
+import numpy as np   # for group -> row broadcasting
+import pandas as pd  # for DataFrame
+
+# local modules
+from niix2bids.decision_tree import utils
+from niix2bids import profiling
+from niix2bids.classes import Volume, Niix2bidsError
+from niix2bids.utils import get_logger, get_nii_ndim, prefetch_nii_headers
+
+
+# '{Column}' or '{Column|transform}'
+field_regex = re.compile(r'\{(\w+)(?:\|(\w+))?\}')
+
+transforms = {
+    'clean': utils.clean_name,                                # ProtocolName -> acq
+    'dir'  : utils.get_phase_encoding_direction,              # j- -> AP
+    'part' : lambda kind: {'M': 'mag', 'P': 'phase'}.get(kind, ''),
+    'echo' : lambda echo: int(echo) if echo > 0 else '',      # with 'fill': {'EchoNumber': -1}
+    'int'  : int,
+    'str'  : lambda value: str(list(value)) if isinstance(value, tuple) else str(value),  # arrays : same text as a list
+}
+
+checks = {
+    'not_4D': lambda vol: get_nii_ndim(vol.nii) < 4,  # a single volume of a 4D sequence, such as a position check
+}
+
+
+########################################################################################################################
+def check_bval_bvec(volumes: List[Volume]) -> None:
+
+    complete = []
+    for vol in volumes:
+        has_bval = vol.check_if_bval_exists()
+        has_bvec = vol.check_if_bvec_exists()
+        if not has_bval:
+            vol.reason_not_ready += '[ no .bval file ]'
+        if not has_bvec:
+            vol.reason_not_ready += '[ no .bvec file ]'
+        if not has_bval or not has_bvec:
+            vol.tag = 'NON_BIDS'  # remove it => this serie will be discarded
+        else:
+            complete.append(vol)
+
+    # their content must also match the nifti : small files, so the time is spent waiting for the disk
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        problems = list(executor.map(utils.get_gradient_problem, complete))
+    for vol, problem in zip(complete, problems):
+        if len(problem) > 0:
+            vol.reason_not_ready += problem
+            vol.tag = 'NON_BIDS'
+
+
+# function(List[Volume]), called once per rule with all its volumes
+actions = {
+    'bval_bvec': check_bval_bvec,
+}
+
+program_keys = {'ndim', 'match', 'rules'}
+rule_keys = {'match', 'fill', 'where', 'check', 'group', 'tag', 'keep_tag', 'suffix', 'entities', 'optional', 'reason',
+             'action', 'consume'}
+
+
+########################################################################################################################
+def raise_error(msg: str) -> None:
+    get_logger().error(msg)
+    raise Niix2bidsError(msg)
+
+
+########################################################################################################################
+def check_template(template) -> None:
+    if isinstance(template, str):
+        for _, transform in field_regex.findall(template):
+            if len(transform) > 0 and transform not in transforms:
+                raise_error(f"unknown transform '{transform}' in template '{template}', use one of {list(transforms)}")
+
+
+########################################################################################################################
+def check_program(name: str, program: dict) -> None:
+    # fail before the decision tree starts, with a message about the config, not a KeyError in the middle
+
+    if not isinstance(program, dict) or not isinstance(program.get('rules'), list):
+        raise_error(f"program '{name}' must be a dict with a 'rules' list")
+    for key in set(program) - program_keys:
+        raise_error(f"unknown key '{key}' in program '{name}', use one of {sorted(program_keys)}")
+
+    for rule in program['rules']:
+        for key in set(rule) - rule_keys:
+            raise_error(f"unknown key '{key}' in a rule of program '{name}', use one of {sorted(rule_keys)}")
+        if 'check' in rule and rule['check'] not in checks:
+            raise_error(f"unknown check '{rule['check']}' in program '{name}', use one of {list(checks)}")
+        if 'action' in rule and rule['action'] not in actions:
+            raise_error(f"unknown action '{rule['action']}' in program '{name}', use one of {list(actions)}")
+        for template in [rule.get('tag'), rule.get('suffix'), rule.get('reason')] + \
+                        list(rule.get('entities', {}).values()):
+            check_template(template)
+
+
+########################################################################################################################
+def get_mask(df: pd.DataFrame, match: Dict[str, str]) -> pd.Series:
+    mask = pd.Series(True, index=df.index)
+    for column, regex in match.items():
+        if regex.startswith('!'):
+            mask &= ~df[column].str.match(regex[1:], na=False).astype(bool)
+        else:
+            mask &= df[column].str.match(regex, na=False).astype(bool)
+    return mask
+
+
+########################################################################################################################
+def render(template, df: pd.DataFrame) -> list:
+    # 1 value per row of df
+
+    if not isinstance(template, str) or field_regex.search(template) is None:
+        return [template] * len(df)  # literal
+
+    fields = field_regex.findall(template)
+    values = []
+    for column, transform in fields:
+        column_values = df[column].tolist()
+        if len(transform) > 0:
+            column_values = [transforms[transform](value) for value in column_values]
+        values.append(column_values)
+
+    if field_regex.fullmatch(template):
+        return values[0]  # keep the type
+
+    literals = field_regex.split(template)[0::3]  # split() also returns the 2 groups of each field
+    return [literals[0] + ''.join(str(value) + literal for value, literal in zip(row, literals[1:]))
+            for row in zip(*values)]
+
+
+########################################################################################################################
+def select(df: pd.DataFrame, rule: dict) -> pd.DataFrame:
+
+    for column, value in rule.get('fill', {}).items():
+        df = df.assign(**{column: df[column].fillna(value) if column in df.columns else value})
+
+    if 'match' in rule:
+        df = df[get_mask(df, rule['match'])]
+
+    if 'where' in rule and not df.empty:
+        df = df[df.eval(rule['where']).astype(bool)]
+
+    if 'check' in rule and not df.empty:
+        check = checks[rule['check']]
+        volumes = df['Volume'].tolist()
+        prefetch_nii_headers([vol.nii for vol in volumes])  # the checks read nifti headers
+        df = df[pd.Series([check(vol) for vol in volumes], index=df.index, dtype=bool)]
+
+    return df
+
+
+########################################################################################################################
+def apply_rule(df: pd.DataFrame, rule: dict) -> pd.Index:
+    # return the index of the rows that were assigned
+
+    df = select(df, rule)
+    if df.empty:
+        return df.index
+
+    values = {}  # attribute -> 1 value per row
+
+    if 'group' in rule:
+
+        # as the former prog_* functions : 1 group per subject and session, rows with a NaN key are left aside
+        keys = ['PatientName', 'BidsSes'] + list(rule['group'])
+        df = df[df[keys].notna().all(axis=1)]
+        if df.empty:
+            return df.index
+        groups = df.groupby(keys, sort=False)
+        df = df.assign(run=groups.cumcount().to_numpy() + 1)  # runs are counted in the order of the rows
+        group_id = groups.ngroup().to_numpy()
+
+        # names are built from the first row of each group, then broadcast to the rows of the group
+        is_first = df['run'].to_numpy() == 1
+        df_first = df[is_first]
+        first_pos = np.empty(len(df_first), dtype=int)
+        first_pos[group_id[is_first]] = np.arange(len(df_first))
+        row_pos = first_pos[group_id]
+
+        def render_group(template) -> list:
+            if isinstance(template, str) and '{run}' in template:
+                return render(template, df)
+            group_values = np.empty(len(df_first), dtype=object)
+            group_values[:] = render(template, df_first)
+            return group_values[row_pos].tolist()
+
+        values['sub'] = render('{PatientName|clean}', df)
+        values['ses'] = df['BidsSes'].tolist()
+
+    else:
+        def render_group(template) -> list:
+            return render(template, df)
+
+    for attribute in ['tag', 'suffix']:
+        if attribute in rule:
+            values[attribute] = render_group(rule[attribute])
+    entities = {key: render_group(template) for key, template in rule.get('entities', {}).items()}
+    optional = set(rule.get('optional', []))
+    if 'reason' in rule:
+        values['reason_not_ready'] = render(rule['reason'], df)
+    keep_tag = rule.get('keep_tag', False)
+
+    # the only loop over rows : the values are ready, store them in each Volume
+    volumes = df['Volume'].tolist()
+    for i, vol in enumerate(volumes):
+        for attribute, attribute_values in values.items():
+            if attribute == 'tag' and keep_tag and len(vol.tag) > 0:
+                continue  # for example a 'NON_BIDS' from 'non-4D'
+            setattr(vol, attribute, attribute_values[i])
+        for key, key_values in entities.items():
+            if key in optional and key_values[i] == '':
+                continue
+            vol.bidsfields[key] = key_values[i]
+
+    if 'action' in rule:
+        actions[rule['action']](volumes)
+
+    return df.index
+
+
+########################################################################################################################
+def apply_program(df: pd.DataFrame, program: dict) -> None:
+
+    # wrong acquisition type : not ready, with a reason
+    if 'ndim' in program:
+        is_ndim = df['MRAcquisitionType'].str.match(program['ndim'], na=False).astype(bool)
+        df_bad = df[~is_ndim]
+        for vol, reason in zip(df_bad['Volume'].tolist(),
+                               render(f"non-{program['ndim']} acquisition with PulseSequenceDetails = "
+                                      f"{{PulseSequenceDetails}}", df_bad)):
+            vol.reason_not_ready = reason
+        df = df[is_ndim]
+
+    if 'match' in program:
+        df = df[get_mask(df, program['match'])]
+
+    for rule in program['rules']:
+        if df.empty:
+            break
+        index = apply_rule(df, rule)
+        if rule.get('consume', False):
+            df = df.drop(index)  # !! important : drop series that we already flagged !!
+
+
+########################################################################################################################
+def add_session_column(df: pd.DataFrame) -> None:
+    # BidsSes : 1, 2, ... for each StudyInstanceUID of a PatientName, in sorted order. NaN : no session, not classified
+    has_key = df[['PatientName', 'StudyInstanceUID']].notna().all(axis=1)
+    ses = pd.Series(np.nan, index=df.index)
+    if has_key.any():
+        df_key = df[has_key]
+        exam_id = df_key.groupby(['PatientName', 'StudyInstanceUID'], sort=True).ngroup()
+        ses[has_key] = exam_id - exam_id.groupby(df_key['PatientName']).transform('min') + 1
+    df['BidsSes'] = ses.astype('Int64')
+
+
+########################################################################################################################
+def run_config(df: pd.DataFrame, config: list, programs: Dict[str, dict]) -> None:
+    """
+    config : list of [PulseSequenceName regex, program], where program is a name in `programs`, or a program dict.
+    Each program is applied on all subjects and sessions at once.
+    """
+
+    # check everything first
+    config_programs = []
+    for seq_regex, program in config:
+        name = program if isinstance(program, str) else seq_regex  # for --profile
+        if isinstance(program, str):
+            if program not in programs:
+                raise_error(f"unknown program '{program}' for '{seq_regex}', use one of {list(programs)}")
+            program = programs[program]
+        check_program(seq_regex, program)
+        config_programs.append((seq_regex, name, program))
+
+    add_session_column(df)
+    has_session = df['BidsSes'].notna()
+
+    for seq_regex, name, program in config_programs:
+        seqinfo = df[has_session & df['PulseSequenceName'].str.match(seq_regex, na=False).astype(bool)]
+        if seqinfo.empty: continue  # just to run the code faster
+        with profiling.stage(name):
+            apply_program(seqinfo, program)
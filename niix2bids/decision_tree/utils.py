@@ -1,14 +1,14 @@
 # standard modules
-import sys               # to stop script execution on case of error
 import re                # regular expressions
 from typing import List  # for function signature
 
 # dependency modules
+import numpy as np  # to parse .bval and .bvec
 import pandas as pd # for DataFrame
 
 # local modules
-from niix2bids.classes import Volume
-from niix2bids.utils import get_logger
+from niix2bids.classes import Volume, Niix2bidsError
+from niix2bids.utils import get_logger, get_nii_shape
 
 
 ########################################################################################################################
@@ -56,7 +56,7 @@ def check_key(df: pd.DataFrame, key: str, msg: str = '', val: str = '') -> pd.Da
     is_key_present = key in df.columns
     if not is_key_present:
         log.error(msg)
-        sys.exit(1)
+        raise Niix2bidsError(msg)
     for row_idx, seq in df.iterrows():
         if pd.isna(seq[key]):
             vol                   = seq['Volume']
@@ -83,23 +83,25 @@ def slice_with_mracquistiontype(df: pd.DataFrame, regex: str) -> pd.DataFrame:
 
 
 ########################################################################################################################
-def slice_with_imagetype(df: pd.DataFrame, imagetype: str) -> pd.DataFrame:
+def add_imagetype_columns(df: pd.DataFrame) -> None:
     """
     ImageType example :
     ['ORIGINAL', 'PRIMARY', 'M', 'MB', 'TE1', 'ND', 'MOSAIC']
-     0           1         >>2<<
-     """
-    return df[df['ImageType'].apply(lambda x: x[2] == imagetype)]
+     Class       Primary   Kind  Flags = 'MBTE1NDMOSAIC'
+    Split once, so the rules can match each part with a vectorized comparison instead of a python lambda per row.
+    The columns are object dtype : the rules read them with tolist(), where str and categorical columns are slower.
+    """
+    image_type = [x if isinstance(x, (list, tuple)) else [] for x in df['ImageType']]  # tuple : see SidecarPool
 
+    def column(values: list) -> pd.Series:
+        return pd.Series(values, index=df.index, dtype=object)
 
-########################################################################################################################
-def slice_with_imagetype_original(df: pd.DataFrame) -> pd.DataFrame:
-    """
-    ImageType example :
-    ['ORIGINAL', 'PRIMARY', 'M', 'MB', 'TE1', 'ND', 'MOSAIC']
-     >>here<<
-     """
-    return df[df['ImageType'].apply(lambda x: x[0] == "ORIGINAL")]
+    # [ORIGINAL, PRIMARY, M, ND, MOSAIC] -> ORIGINAL_PRIMARY_M_ND_MOSAIC
+    df['ImageTypeStr']     = column(['_'.join(x) for x in image_type])
+    df['ImageTypeClass']   = column([x[0] if len(x) > 0 else None for x in image_type])
+    df['ImageTypePrimary'] = column([x[1] if len(x) > 1 else None for x in image_type])
+    df['ImageTypeKind']    = column([x[2] if len(x) > 2 else None for x in image_type])
+    df['ImageTypeFlags']   = column([''.join(x[3:]) for x in image_type])
 
 
 ########################################################################################################################
@@ -124,54 +126,42 @@ def get_phase_encoding_direction(input_str: str) -> str:
 
 
 ########################################################################################################################
-def keep_ndim(df: pd.DataFrame, ndim: str) -> pd.DataFrame:
-    df_ND = slice_with_genericfield(df, 'MRAcquisitionType', ndim)
-    df_bad = df.drop(df_ND.index)
-    for _, seq in df_bad.iterrows():
-        vol                   = seq['Volume']
-        vol.reason_not_ready  = f"non-{ndim} acquisition with PulseSequenceDetails = {seq['PulseSequenceDetails']}"
-    return df_ND
-
-
-########################################################################################################################
-def fill_echonumber(df: pd.DataFrame, value: int = -1) -> pd.DataFrame:
-    """
-    DataFrame CANNOT iterate overs groups with nan.
-    So here is a workaround, replace NaN with -1
-    """
-    nan_in_EchoNumber = pd.isna(df['EchoNumber'])
-    if any(nan_in_EchoNumber):
-        pd.options.mode.chained_assignment = None  # because of super onnoying warning that appears in some case but not all...
-        df['EchoNumber'] = df['EchoNumber'].fillna(value)
-        pd.options.mode.chained_assignment = 'warn'
-    return df
-
-
-########################################################################################################################
-def get_mag_or_pha(df: pd.DataFrame) -> str:
-    mag_or_pha = df["ImageTypeStr"].split('_')[2]
-    if mag_or_pha == 'M':
-        suffix = 'mag'
-    elif mag_or_pha == 'P':
-        suffix = 'phase'
-    else:
-        suffix = ''
-    return suffix
-
-
-########################################################################################################################
-def get_echo_number(df: pd.DataFrame, has_EchoNumber: bool) -> int:
-    if has_EchoNumber:
-        echo = int(df['EchoNumber'])
-    else:
-        echo = -1
-    return echo
+def read_gradient_file(file) -> np.ndarray:
+    # .bval : 1 row, .bvec : 3 rows (x, y, z), values separated by spaces. Raise ValueError if malformed
+    with file.open('r') as fp:
+        rows = [line.split() for line in fp.read().splitlines() if len(line.strip()) > 0]
+    if len(rows) == 0:
+        raise ValueError('empty')
+    if len({len(row) for row in rows}) > 1:
+        raise ValueError(f"rows of different lengths : {[len(row) for row in rows]}")
+    values = np.array(rows, dtype=float)  # ValueError for a non numeric value
+    if not np.isfinite(values).all():
+        raise ValueError('non finite value')
+    return values
 
 
 ########################################################################################################################
-def complete_columns_with_echonumber(columns: list, df: pd.DataFrame) -> [list, pd.DataFrame, bool] :
-    has_EchoNumber = 'EchoNumber' in df.columns
-    if has_EchoNumber:
-        columns.append('EchoNumber')
-        df = fill_echonumber(df)
-    return columns, df, has_EchoNumber
+def get_gradient_problem(vol: Volume) -> str:
+    # '' if the .bval, the .bvec and the nifti 4th dimension agree, else the reason_not_ready
+    # only the nifti header is read
+
+    try:
+        bval = read_gradient_file(vol.bval)
+    except ValueError as err:
+        return f"[ malformed .bval : {err} ]"
+    try:
+        bvec = read_gradient_file(vol.bvec)
+    except ValueError as err:
+        return f"[ malformed .bvec : {err} ]"
+
+    if bval.shape[0] != 1:
+        return f"[ malformed .bval : {bval.shape[0]} rows instead of 1 ]"
+    if bvec.shape[0] != 3:
+        return f"[ malformed .bvec : {bvec.shape[0]} rows instead of 3 ]"
+
+    shape = get_nii_shape(vol.nii)
+    n_volume = shape[3] if len(shape) > 3 else 1
+    if not bval.shape[1] == bvec.shape[1] == n_volume:
+        return f"[ {bval.shape[1]} .bval values, {bvec.shape[1]} .bvec directions, {n_volume} nifti volumes ]"
+
+    return ''
@@ -0,0 +1,161 @@
+# standard modules
+import os                 # for path management
+import hashlib            # to name the output directory of each in_dir
+import shlex              # to split the dcm2niix flags
+import shutil             # to find dcm2niix on PATH
+import logging            # for @logit
+import subprocess         # to run dcm2niix
+import concurrent.futures # to run several dcm2niix at a time
+from typing import List   # for function signature
+
+# dependency modules
+
+# local modules
+from niix2bids import progress
+from niix2bids.classes import Niix2bidsError
+from niix2bids.utils import get_logger, logit
+
+
+# -ba n : no anonymization, PatientName is needed by the decision tree
+# -z y  : .nii.gz
+# -f    : output file name, %p protocol name, %s series number
+default_flags = '-b y -ba n -z y -f %p_%s'
+
+dicom_ext   = ('.dcm', '.ima')
+max_probe   = 10                           # files tested per directory, when they have no DICOM extension
+done_marker = '.niix2bids_dcm2niix_done'   # written in the output directory of each converted series
+
+
+########################################################################################################################
+def get_nifti_dir(out_dir: str) -> str:
+    # sourcedata/ is ignored by the BIDS validator, and the symlinks of out_dir point here
+    return os.path.join(out_dir, 'sourcedata', 'dcm2niix')
+
+
+########################################################################################################################
+def get_in_dir_name(one_dir: str) -> str:
+    # its name, and a hash of its absolute path : /site_a/raw and /site_b/raw do not share their series
+    # stable across runs, whatever the other in_dir, so the series already converted are found again
+    one_dir = os.path.abspath(one_dir)
+    digest = hashlib.md5(one_dir.encode()).hexdigest()[:8]
+    return f"{os.path.basename(one_dir)}_{digest}"
+
+
+########################################################################################################################
+def is_dicom_file(path: str) -> bool:
+    if path.lower().endswith(dicom_ext):
+        return True
+    try:
+        with open(path, 'rb') as fp:
+            return fp.read(132)[128:] == b'DICM'  # 128 bytes preamble, then the magic
+    except OSError:
+        return False
+
+
+########################################################################################################################
+def find_dicom_dirs(in_dir: List[str], dir_filter=None) -> List[str]:
+    # 1 series per directory that directly contains DICOM files, as written by most PACS exports
+    # dir_filter : function(name) -> bool, for the directories directly in in_dir. The rejected ones are not explored
+    dicom_dirs = []
+    for one_dir in in_dir:
+        for root, dirs, files in os.walk(one_dir):
+            if dir_filter is not None and root == one_dir:
+                dirs[:] = [dir for dir in dirs if dir_filter(dir)]
+            dirs.sort()
+            files = sorted(files)
+            if any(file.lower().endswith(dicom_ext) for file in files) or \
+                    any(is_dicom_file(os.path.join(root, file)) for file in files[:max_probe]):
+                dicom_dirs.append(root)
+    return dicom_dirs
+
+
+########################################################################################################################
+def get_command(dcm2niix: str, flags: str) -> List[str]:
+    # the executable : a path, or a name found on PATH
+    executable = shutil.which(dcm2niix)
+    if executable is None:
+        msg = f"dcm2niix executable not found : {dcm2niix}"
+        get_logger().error(msg)
+        raise Niix2bidsError(msg)
+
+    args = shlex.split(flags)
+    if '-ba' not in args:
+        args += ['-ba', 'n']
+    elif args[args.index('-ba') + 1:][:1] != ['n']:
+        get_logger().warning(f"dcm2niix flags without '-ba n' : PatientName will be missing in the .json, "
+                             f"the volumes will not be classified")
+    return [executable] + args
+
+
+########################################################################################################################
+def run_dcm2niix(command: List[str], dicom_dir: str, nifti_dir: str) -> List[str]:
+    # return the files written in nifti_dir. A series already converted by a previous run is not converted again
+
+    marker = os.path.join(nifti_dir, done_marker)
+    if not os.path.exists(marker):
+        os.makedirs(nifti_dir, exist_ok=True)
+        for entry in os.scandir(nifti_dir):
+            if entry.is_file(follow_symlinks=False):
+                os.remove(entry.path)  # left by an interrupted conversion : dcm2niix would add a suffix to the names
+        res = subprocess.run(command + ['-o', nifti_dir, dicom_dir], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             stdin=subprocess.DEVNULL, text=True, errors='replace')
+        if res.returncode != 0:
+            tail = '\n'.join(res.stdout.splitlines()[-5:])
+            raise RuntimeError(f"dcm2niix failed with code {res.returncode} : {dicom_dir}\n{tail}")
+        open(marker, 'w').close()
+
+    return sorted(entry.path for entry in os.scandir(nifti_dir)
+                  if entry.is_file(follow_symlinks=False) and entry.name != done_marker)
+
+
+########################################################################################################################
+@logit('Convert DICOM series with dcm2niix. This might take time, several dcm2niix run in parallel.', logging.INFO)
+def convert_all(in_dir: List[str], out_dir: str, dcm2niix: str = 'dcm2niix', flags: str = default_flags,
+                jobs: int = None, dir_filter=None) -> List[str]:
+    """
+    Each DICOM series directory of in_dir is converted in out_dir/sourcedata/dcm2niix/<in_dir name>_<hash>/<relative
+    path>, see get_in_dir_name().
+    Return the list of produced files, for the rest of the pipeline : the output tree is not explored again.
+    jobs : number of dcm2niix processes at a time, default is the number of CPUs.
+    dir_filter : see find_dicom_dirs().
+    """
+
+    log = get_logger()
+
+    command = get_command(dcm2niix, flags)
+    log.info(f"dcm2niix command : {' '.join(shlex.quote(arg) for arg in command)}")  # shlex.join needs python 3.8
+
+    dicom_dirs = find_dicom_dirs(in_dir, dir_filter)
+    log.info(f"found {len(dicom_dirs)} DICOM series")
+    if len(dicom_dirs) == 0:
+        log.error(f"no DICOM file found in {in_dir}")
+        raise Niix2bidsError(f"no DICOM file found in {in_dir}")
+
+    # the tree of in_dir is kept : 2 series with the same name in 2 exams do not mix
+    nifti_root = get_nifti_dir(out_dir)
+    nifti_dirs = []
+    for dicom_dir in dicom_dirs:
+        one_dir = next(one_dir for one_dir in in_dir if os.path.commonpath([one_dir, dicom_dir]) == one_dir)
+        name = os.path.join(get_in_dir_name(one_dir), os.path.relpath(dicom_dir, one_dir))
+        nifti_dirs.append(os.path.normpath(os.path.join(nifti_root, name)))
+
+    # dcm2niix processes : the threads only wait for them
+    file_list = []
+    failed = 0
+    with progress.Progress('convert_dicom', len(dicom_dirs), 'series') as prog, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = {executor.submit(run_dcm2niix, command, dicom_dir, nifti_dir): dicom_dir
+                   for dicom_dir, nifti_dir in zip(dicom_dirs, nifti_dirs)}
+        for future in concurrent.futures.as_completed(futures):
+            prog.update()
+            try:
+                file_list += future.result()
+            except (RuntimeError, OSError) as err:
+                log.error(f"{err}")
+                failed += 1
+
+    if failed > 0:
+        log.warning(f"{failed} DICOM series not converted, they will be converted again by the next run")
+
+    file_list.sort()
+    return file_list
@@ -0,0 +1,80 @@
+# standard modules
+import os                # for path management
+import json              # shape and voxel sizes are stored as json lists
+import sqlite3           # persistent storage, safe with several processes (shards)
+import threading         # the headers are read by several threads
+from typing import Tuple  # for function signature
+
+# dependency modules
+
+# local modules
+
+
+########################################################################################################################
+def get_cache_file(out_dir: str) -> str:
+    return os.path.join(out_dir, 'niix2bids_header_cache.sqlite')
+
+
+########################################################################################################################
+class HeaderCache:
+    """
+    Nifti header information (shape, voxel sizes, datatype), persistent across runs.
+    Each entry is valid while the file keeps the same size and mtime.
+    The whole cache is loaded in memory when opened, the new entries are written by close(), in 1 transaction.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, path: str):
+
+        # instance filling
+        self.path    = path
+        self.entries = {}  # nifti path -> (size, mtime_ns, info)
+        self.new     = {}  # nifti path -> (size, mtime_ns, info), not yet written
+        self.lock    = threading.Lock()
+        self.counted = set()  # nifti paths already counted as hit or miss : prefetch, then the decision tree
+        self.hits    = 0
+        self.misses  = 0
+
+        with self.connect() as connection:
+            for path, size, mtime_ns, shape, zooms, datatype in connection.execute(
+                    'SELECT path, size, mtime_ns, shape, zooms, datatype FROM header'):
+                self.entries[path] = (size, mtime_ns, {'shape': tuple(json.loads(shape)),
+                                                       'zooms': tuple(json.loads(zooms)), 'datatype': datatype})
+        connection.close()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=60)  # several shards can share the same cache
+        connection.execute('CREATE TABLE IF NOT EXISTS header (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                           'shape TEXT, zooms TEXT, datatype TEXT)')
+        return connection
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def get(self, path: str, stat: Tuple[int, int]) -> dict:
+        # stat : (size, mtime_ns) of the file now. None if not cached, or if the file changed since
+        # each file is counted once, by its first lookup : the later ones find the header read after a miss
+        with self.lock:
+            entry = self.entries.get(path)
+            hit = entry is not None and entry[:2] == stat
+            if path not in self.counted:
+                self.counted.add(path)
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            return entry[2] if hit else None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def put(self, path: str, stat: Tuple[int, int], info: dict) -> None:
+        with self.lock:
+            self.entries[path] = self.new[path] = (stat[0], stat[1], info)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self) -> None:
+        if len(self.new) > 0:
+            with self.connect() as connection:  # commit
+                connection.executemany('INSERT OR REPLACE INTO header VALUES (?, ?, ?, ?, ?, ?)',
+                                       [(path, size, mtime_ns, json.dumps(info['shape']), json.dumps(info['zooms']),
+                                         info['datatype']) for path, (size, mtime_ns, info) in self.new.items()])
+            connection.close()
+            self.new = {}
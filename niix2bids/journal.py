@@ -0,0 +1,75 @@
+# standard modules
+import os         # for path management
+import threading  # the transcodings are done by several threads
+
+# dependency modules
+
+# local modules
+
+
+########################################################################################################################
+def get_journal_file(out_dir: str, suffix: str = '') -> str:
+    return os.path.join(out_dir, f"niix2bids_journal{suffix}.tsv")
+
+
+########################################################################################################################
+class Journal:
+    """
+    Append-only list of the files completely written in out_dir, 1 line per file : out_path (relative), in_path.
+    Each file is written under a temporary name then renamed, and only then added here : a resumed run can skip the
+    journaled files without checking them, and a file interrupted by a crash is never in the journal.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, path: str):
+
+        # instance filling
+        self.path    = path
+        self.out_dir = os.path.dirname(path)
+        self.done    = {}    # out_path (relative) -> in_path, the last line wins
+        self.lock    = threading.Lock()
+        self.fp      = None
+
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                content = fp.read()
+            for line in content.splitlines():
+                fields = line.split('\t')
+                if len(fields) == 2:  # the last line can be truncated by a crash
+                    self.done[fields[0]] = fields[1]
+        else:
+            content = ''
+
+        self.fp = open(path, 'a', buffering=1)  # line buffering : each line is written as soon as it is complete
+        if len(content) > 0 and not content.endswith('\n'):
+            self.fp.write('\n')  # do not append to a truncated line
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def get_name(self, out_path: str) -> str:
+        return os.path.relpath(out_path, self.out_dir)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def is_done(self, in_path: str, out_path: str) -> bool:
+        return self.done.get(self.get_name(out_path)) == in_path
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add(self, in_path: str, out_path: str) -> None:
+        name = self.get_name(out_path)
+        with self.lock:
+            self.done[name] = in_path
+            self.fp.write(f"{name}\t{in_path}\n")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def remove(self, out_path: str) -> None:
+        # empty in_path : the file was removed from out_dir, it is not done anymore
+        name = self.get_name(out_path)
+        with self.lock:
+            if name in self.done:
+                self.done[name] = ''
+                self.fp.write(f"{name}\t\n")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self) -> None:
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
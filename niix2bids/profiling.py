@@ -0,0 +1,205 @@
+# standard modules
+import os                # for path management
+import re                # regular expressions
+import cProfile          # --profile cpu
+import pstats            # to save the cpu profiles
+import tracemalloc       # --profile memory
+import contextlib        # for the stage() context manager
+import threading         # the profiler of a call is only seen by its thread
+from typing import List  # for function signature
+
+# dependency modules
+
+# local modules
+from niix2bids.classes import Niix2bidsError
+
+
+# Profiler of the running call, per thread, set by scope(). Without it, stage() only returns a shared empty context
+# manager, so the other calls of the process are not profiled
+current = threading.local()
+
+# tracemalloc, and cProfile since python 3.12, are process-wide : only 1 call is profiled at a time
+running = threading.Lock()
+
+memory_top = 10  # allocation sites per stage
+
+
+########################################################################################################################
+class NullContext:
+    # contextlib.nullcontext needs python 3.7
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+disabled = NullContext()
+
+
+########################################################################################################################
+def reset_peak() -> None:
+    if hasattr(tracemalloc, 'reset_peak'):  # python 3.9+
+        tracemalloc.reset_peak()
+    else:
+        # older python : restart the tracing, which also drops the traces of the running stages.
+        # the innermost stages are right, but their parent stages are underestimated
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+########################################################################################################################
+def get_profile_dir(out_dir: str) -> str:
+    return os.path.join(out_dir, 'niix2bids_profile')
+
+
+########################################################################################################################
+def get_file_name(name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+########################################################################################################################
+class Profiler:
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, mode: str, out_dir: str):
+
+        if mode not in ['cpu', 'memory']:
+            raise ValueError(f"profile mode must be 'cpu' or 'memory' : {mode}")
+
+        # instance filling
+        self.mode            = mode
+        self.profile_dir     = get_profile_dir(out_dir)
+        self.stack           = []  # names of the running stages, the last one is profiled
+        self.cpu_profiles    = {}  # stage name -> cProfile.Profile, the calls of each stage are summed (chunks, ...)
+        self.memory_peak     = []  # 1 per running stage : peak seen by its nested stages, tracemalloc peak is global
+        self.memory_sections = []  # 1 text section per finished stage
+
+        if mode == 'memory':
+            tracemalloc.start()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def stage(self, name: str):
+
+        # same stage (logit function called by the workflow's timeit), or nested profiling : count it in the running one
+        if len(self.stack) > 0 and self.stack[-1] == name:
+            yield
+            return
+
+        if self.mode == 'cpu':
+
+            # only 1 profiler can run : the parent stage is paused, so each file only has the calls of its own stage
+            if len(self.stack) > 0:
+                self.cpu_profiles[self.stack[-1]].disable()
+            self.stack.append(name)
+            profile = self.cpu_profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self.stack.pop()
+                if len(self.stack) > 0:
+                    self.cpu_profiles[self.stack[-1]].enable()
+
+        else:
+
+            # only the allocations of the top stage are traced : the snapshots stay small, so they are fast to compare
+            # the sizes are relative to the start of the top stage, not the memory of the whole process
+            if len(self.stack) == 0:
+                tracemalloc.clear_traces()
+            # the peak is global : save the one of the parent stage before reset
+            if len(self.memory_peak) > 0:
+                self.memory_peak[-1] = max(self.memory_peak[-1], tracemalloc.get_traced_memory()[1])
+            reset_peak()
+            self.stack.append(name)
+            self.memory_peak.append(0)
+            before = tracemalloc.take_snapshot()
+            start_size = tracemalloc.get_traced_memory()[0]
+            try:
+                yield
+            finally:
+                size, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self.memory_peak.pop())
+                after = tracemalloc.take_snapshot()
+                self.stack.pop()
+                if len(self.memory_peak) > 0:
+                    self.memory_peak[-1] = max(self.memory_peak[-1], peak)
+                self.add_memory_section(name, start_size, size, peak, after.compare_to(before, 'lineno'))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add_memory_section(self, name: str, start_size: int, size: int, peak: int,
+                           stats: List[tracemalloc.StatisticDiff]) -> None:
+        from niix2bids.utils import format_bytes  # lazy import : niix2bids.utils imports this module
+
+        lines = [f"{name} : peak {format_bytes(peak - start_size)}, {format_bytes(size - start_size)} still "
+                 f"allocated at the end"]
+        stats = [stat for stat in stats if stat.size_diff > 0 and stat.traceback[0].filename != tracemalloc.__file__]
+        for stat in sorted(stats, key=lambda stat: stat.size_diff, reverse=True)[:memory_top]:
+            frame = stat.traceback[0]
+            lines.append(f"  {'+' + format_bytes(stat.size_diff):>10} {stat.count_diff:>+8} blocks  "
+                         f"{frame.filename}:{frame.lineno}")
+        self.memory_sections.append(lines)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def stop(self) -> None:
+        # write the results in out_dir/niix2bids_profile
+        from niix2bids.utils import get_logger  # lazy import : niix2bids.utils imports this module
+
+        log = get_logger()
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+        if self.mode == 'cpu':
+            for name, profile in self.cpu_profiles.items():
+                path = os.path.join(self.profile_dir, f"cpu_{get_file_name(name)}.pstats")
+                profile.dump_stats(path)
+                total = pstats.Stats(profile).total_tt
+                log.info(f"cpu profile : {total:8.3f}s {name}")
+            log.info(f"cpu profiles : {self.profile_dir} , read them with : python -m pstats FILE")
+
+        else:
+            tracemalloc.stop()
+            path = os.path.join(self.profile_dir, 'memory.txt')
+            with open(path, 'w') as fp:
+                for lines in self.memory_sections:
+                    fp.write('\n'.join(lines) + '\n\n')
+                    log.info(f"memory profile : {lines[0]}")
+            log.info(f"memory profile : {path}")
+
+
+########################################################################################################################
+@contextlib.contextmanager
+def scope(mode: str, out_dir: str):
+    # profile the stages run by the calling thread in this block. mode : None (disabled), 'cpu' or 'memory'
+    # the results are written at the end, also for a failed call, to see where it went
+    from niix2bids.utils import get_logger  # lazy import : niix2bids.utils imports this module
+
+    if mode is None:
+        yield
+        return
+
+    if not running.acquire(blocking=False):
+        msg = "another call of this process is already profiled : only 1 at a time"
+        get_logger().error(msg)
+        raise Niix2bidsError(msg)
+    try:
+        profiler = Profiler(mode, out_dir)
+        current.profiler = profiler
+        try:
+            yield
+        finally:
+            current.profiler = None
+            profiler.stop()
+    finally:
+        running.release()
+
+
+########################################################################################################################
+def stage(name: str):
+    # usage : with profiling.stage('read_all_json'): ...
+    profiler = getattr(current, 'profiler', None)
+    if profiler is None:
+        return disabled
+    return profiler.stage(name)
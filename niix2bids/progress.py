@@ -0,0 +1,207 @@
+# standard modules
+import sys               # the tty line is written on stderr
+import time              # for throughput and ETA
+import logging           # the default renderer writes log lines
+import threading         # to report stalled stages, such as a hung NFS mount
+import contextlib        # for the scope() context manager
+from typing import NamedTuple  # for function signature
+
+# dependency modules
+
+# local modules
+
+
+# renderer of the running call, function(Event) or None, and seconds between 2 events of a stage.
+# per thread, set by scope() : several convert() calls in the same process do not overwrite each other's
+current = threading.local()
+default_interval = 10.
+
+
+########################################################################################################################
+class Event(NamedTuple):
+    stage      : str    # such as 'read_all_json'
+    unit       : str    # such as 'files', 'volumes'
+    done       : int
+    total      : int    # None when unknown, such as while the disk tree is explored
+    done_bytes : int
+    total_bytes: int    # 0 when the stage does not count bytes
+    elapsed    : float  # seconds since the start of the stage
+    idle       : float  # seconds since the last item : a large value with no progress means the stage is stalled
+    final      : bool   # last event of the stage
+    stalled    : bool   # no progress for more than the interval between 2 events
+
+    @property
+    def rate(self) -> float:
+        return self.done / self.elapsed if self.elapsed > 0 else 0.
+
+    @property
+    def byte_rate(self) -> float:
+        return self.done_bytes / self.elapsed if self.elapsed > 0 else 0.
+
+    @property
+    def eta(self) -> float:
+        # from the bytes when they are known (a few big copies make the count misleading), else from the items
+        if self.total_bytes > 0 and self.done_bytes > 0:
+            return (self.total_bytes - self.done_bytes) / self.byte_rate
+        if self.total is not None and self.done > 0:
+            return (self.total - self.done) / self.rate
+        return None
+
+
+########################################################################################################################
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m"
+
+
+########################################################################################################################
+def format_event(event: Event) -> str:
+    from niix2bids.utils import format_bytes  # lazy import : niix2bids.utils imports this module
+
+    if event.total is None:
+        text = f"{event.stage} : {event.done} {event.unit}"
+    else:
+        percent = 100 * event.done / event.total if event.total > 0 else 100
+        text = f"{event.stage} : {event.done}/{event.total} {event.unit} ({percent:.0f}%)"
+    text += f", {event.rate:.1f} {event.unit}/s"
+    if event.done_bytes > 0:
+        text += f", {format_bytes(event.done_bytes)} at {format_bytes(event.byte_rate)}/s"
+    if event.final:
+        text += f", done in {format_duration(event.elapsed)}"
+    elif event.eta is not None:
+        text += f", ETA {format_duration(event.eta)}"
+    if event.stalled:
+        text += f", no progress for {format_duration(event.idle)}"
+    return text
+
+
+########################################################################################################################
+def log_renderer(event: Event) -> None:
+    # for batch jobs : plain lines, in the console and in the logfile
+    logging.getLogger(f"{__name__}:{event.stage}").info(format_event(event))
+
+
+########################################################################################################################
+def tty_renderer(event: Event) -> None:
+    # 1 line, rewritten in place
+    sys.stderr.write('\r' + format_event(event) + '\033[K' + ('\n' if event.final else ''))
+    sys.stderr.flush()
+
+
+renderers = {
+    'log' : log_renderer,
+    'tty' : tty_renderer,
+    'none': None,
+}
+
+
+########################################################################################################################
+def get_renderer():
+    return getattr(current, 'renderer', None)
+
+
+########################################################################################################################
+@contextlib.contextmanager
+def scope(renderer, interval: float = None):
+    # the stages run by the calling thread in this block send their events to renderer
+    # renderer : a name in `renderers`, a function(Event), for example to update a GUI, or None
+    previous = (get_renderer(), getattr(current, 'interval', default_interval))
+    current.renderer = renderers[renderer] if isinstance(renderer, str) else renderer
+    current.interval = default_interval if interval is None else interval
+    try:
+        yield
+    finally:
+        current.renderer, current.interval = previous
+
+
+########################################################################################################################
+class Progress:
+    """
+    Count the items of a stage, and send an Event to the renderer at most every `interval` seconds.
+    A background thread also sends an Event when nothing moved for `interval` seconds, so a stalled stage is visible.
+    Short stages send nothing : the final Event is only sent if the stage already sent one.
+    Usage :
+        with Progress('read_all_json', len(volume_list), 'volumes') as progress:
+            for ...: progress.update()
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, stage: str, total: int = None, unit: str = 'files', total_bytes: int = 0):
+
+        # instance filling
+        self.stage       = stage
+        self.total       = total
+        self.unit        = unit
+        self.total_bytes = total_bytes
+        self.done        = 0
+        self.done_bytes  = 0
+        self.renderer    = get_renderer()  # fixed for the whole stage, even when updated by other threads
+        self.interval    = getattr(current, 'interval', default_interval)
+        self.start_time  = time.monotonic()
+        self.last_update = self.start_time  # time of the last item
+        self.last_event  = self.start_time  # time of the last event sent
+        self.sent        = False
+        self.lock        = threading.Lock()  # update() can be called by several threads
+        self.stopped     = threading.Event()
+        self.watchdog    = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __enter__(self):
+        if self.renderer is not None:
+            self.watchdog = threading.Thread(target=self.watch, name=f"progress:{self.stage}", daemon=True)
+            self.watchdog.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def get_event(self, now: float, final: bool = False) -> Event:
+        idle = now - self.last_update
+        return Event(self.stage, self.unit, self.done, self.total, self.done_bytes, self.total_bytes,
+                     now - self.start_time, idle, final, not final and idle >= self.interval)
+
+    def send(self, event: Event) -> None:
+        self.sent = True
+        self.renderer(event)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def update(self, count: int = 1, nbytes: int = 0) -> None:
+        if self.renderer is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.done += count
+            self.done_bytes += nbytes
+            self.last_update = now
+            if now - self.last_event < self.interval:
+                return
+            self.last_event = now
+            self.send(self.get_event(now))  # in the lock : the events of the 2 threads stay in order
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def watch(self) -> None:
+        # wake up every interval : if no event was sent meanwhile, the stage is stalled
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                now = time.monotonic()
+                if now - self.last_event < self.interval:
+                    continue
+                self.last_event = now
+                self.send(self.get_event(now))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self) -> None:
+        if self.renderer is None:
+            return
+        self.stopped.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+            self.watchdog = None
+        if self.sent:
+            self.send(self.get_event(time.monotonic(), final=True))
+        self.renderer = None  # close() can be called twice
@@ -0,0 +1,129 @@
+# standard modules
+import os                # for path management
+import csv               # to write the .tsv report
+import logging           # to log the summary
+from typing import List  # for function signature
+
+# dependency modules
+
+# local modules
+from niix2bids.classes import Volume
+
+
+# 1 row per volume
+columns = ['in_path', 'out_path', 'tag', 'suffix', 'status', 'reason']
+
+# status -> log level of the summary, in the order of display
+status_level = {
+    'not_interpreted': logging.ERROR,    # bug in the decision tree : no tag, no reason
+    'unknown'        : logging.WARNING,  # UNKNOWN/
+    'not_ready'      : logging.WARNING,  # not written, see reason
+    'collision'      : logging.WARNING,  # not written, another volume has the same destination
+    'non_bids'       : logging.WARNING,  # NON_BIDS/
+    'discard'        : logging.WARNING,  # DISCARD/
+    'bids'           : logging.INFO,     # sub-<>/ses-<>/<tag>/
+    'duplicate'      : logging.INFO,     # removed before the decision tree, see reason
+}
+
+
+########################################################################################################################
+def get_status(vol: Volume) -> str:
+    if len(vol.collision) > 0:
+        return 'collision'
+    elif len(vol.tag) > 0:
+        return {'DISCARD': 'discard', 'NON_BIDS': 'non_bids', 'UNKNOWN': 'unknown'}.get(vol.tag, 'bids')
+    elif len(vol.reason_not_ready) > 0:
+        return 'not_ready'
+    else:
+        return 'not_interpreted'
+
+
+########################################################################################################################
+def get_report_file(out_dir: str, suffix: str = '') -> str:
+    return os.path.join(out_dir, f"niix2bids_report{suffix}.tsv")
+
+
+########################################################################################################################
+class Report:
+    """
+    Rows are written to the .tsv as soon as they are added, only the counters stay in memory.
+    Without path, only the counters are kept.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, path: str = '', append: bool = False):
+
+        # instance filling
+        self.path          = path
+        self.count_status  = {}  # status -> count
+        self.count_reason  = {}  # (status, reason) -> count
+        self.fp            = None
+        self.writer        = None
+        self.collisions    = []  # filled by merge_reports()
+
+        if len(path) > 0:
+            write_header = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+            self.fp = open(path, 'a' if append else 'w', newline='')
+            self.writer = csv.writer(self.fp, delimiter='\t', lineterminator='\n')
+            if write_header:
+                self.writer.writerow(columns)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add(self, in_path: str, out_path: str, tag: str, suffix: str, status: str, reason: str) -> None:
+        if self.writer is not None:
+            self.writer.writerow([in_path, out_path, tag, suffix, status, reason])
+        self.count_status[status] = self.count_status.get(status, 0) + 1
+        if status == 'duplicate':
+            reason = 'duplicate series'  # the reason holds the path of the canonical copy, do not count each one
+        elif status == 'collision':
+            reason = 'same destination as another volume'
+        if status != 'bids':
+            self.count_reason[(status, reason)] = self.count_reason.get((status, reason), 0) + 1
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self) -> None:
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+            self.writer = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def log_summary(self, log: logging.Logger) -> None:
+
+        total = sum(self.count_status.values())
+        log.info(f"{total} volumes : " +
+                 ', '.join(f"{self.count_status.get(status, 0)} {status}" for status in status_level))
+
+        # 1 line per reason, instead of 1 line per volume
+        order = list(status_level.keys())
+        for (status, reason), count in sorted(self.count_reason.items(),
+                                              key=lambda item: (order.index(item[0][0]), -item[1], item[0][1])):
+            log.log(status_level[status], f"{count:>6} x {status:<15} : {reason}")
+
+        if len(self.path) > 0:
+            log.info(f"report : {self.path}")
+
+
+########################################################################################################################
+def merge_reports(in_paths: List[str], out_path: str) -> Report:
+    # concatenate several .tsv reports, the header is written once
+    # each report checked its own collisions, but 2 reports can have the same out_path : the row of the second one
+    # gets the 'collision' status, and report.collisions lists (out_path, first in_path, in_path)
+    report = Report(out_path)
+    destinations = {}  # out_path -> in_path
+    for in_path in in_paths:
+        with open(in_path, 'r', newline='') as fp:
+            reader = csv.reader(fp, delimiter='\t')
+            next(reader, None)  # header
+            for row in reader:
+                if len(row) != len(columns):
+                    continue
+                row_in_path, row_out_path = row[0], row[1]
+                if len(row_out_path) > 0:
+                    first_in_path = destinations.setdefault(row_out_path, row_in_path)
+                    if first_in_path != row_in_path:
+                        report.collisions.append((row_out_path, first_in_path, row_in_path))
+                        row = [row_in_path, '', row[2], row[3], 'collision', f"same destination as {first_in_path}"]
+                report.add(*row)
+    report.close()
+    return report
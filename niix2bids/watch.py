@@ -0,0 +1,238 @@
+# standard modules
+import os                             # for path management
+import time                           # for polling
+from typing import List, Dict         # for function signature
+
+# dependency modules
+
+# local modules
+from niix2bids import utils
+from niix2bids.classes import Volume, Niix2bidsError
+from niix2bids.report import Report, get_report_file
+from niix2bids.journal import Journal, get_journal_file
+from niix2bids.utils import get_logger
+
+
+# files written by dcm2niix, the ones that define a "session" directory
+sidecar_ext = ('.nii', '.nii.gz', '.json', '.bval', '.bvec')
+
+
+########################################################################################################################
+class Watcher:
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, in_dir: List[str], out_dir: str, symlink_or_copyfile: str, config_file, quiescence: float,
+                 catalog: bool = False):
+
+        # instance filling
+        self.in_dir              = in_dir
+        self.out_dir             = out_dir
+        self.symlink_or_copyfile = symlink_or_copyfile
+        self.quiescence          = quiescence  # in seconds, a session is "ready" when its files stopped changing
+        self.dir_mtime           = {}          # directory -> mtime, so only modified directories are listed again
+        self.dir_subdirs         = {}          # directory -> sub-directories, from the last listing
+        self.pending             = {}          # directory -> (signature, time of last change), waiting for quiescence
+        self.done                = {}          # directory -> signature, when it was processed
+        self.volumes             = {}          # directory -> List[Volume], results of the previous cycles
+        self.subject_dirs        = {}          # PatientName -> set of directories
+        self.destinations        = {}          # path without extension -> in_path, to detect collisions between cycles
+        self.catalog             = catalog     # update out_dir/niix2bids_catalog.parquet after each cycle
+        self.config_path         = utils.find_config_file(config_file)
+        self.config_mtime        = None
+        self.config              = []
+        self.load_config()
+        if catalog:
+            import niix2bids.catalog  # lazy import : pandas is only imported when needed
+            niix2bids.catalog.check_engine()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def load_config(self) -> None:
+        # (re)load the config file only when it was modified
+        mtime = os.stat(self.config_path).st_mtime_ns
+        if mtime != self.config_mtime:
+            if self.config_mtime is not None:
+                get_logger().info(f"config_file modified, reloading it : {self.config_path}")
+            self.config_mtime = mtime  # if it fails, wait for the next modification
+            self.config = utils.load_config_file(self.config_path)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def get_signature(dir_path: str) -> frozenset:
+        # the signature of a session is its sidecar set : if it did not change, dcm2niix is done with this directory
+        signature = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.name.endswith(sidecar_ext) and entry.is_file():
+                        stat = entry.stat()
+                        signature.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+        return frozenset(signature)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def scan(self) -> Dict[str, frozenset]:
+
+        now = time.time()
+
+        # walk the tree, but only list the directories that have a new mtime (files or sub-directories added/removed)
+        # for the others, 1 stat is enough
+        modified = []
+        seen = set()
+        stack = list(self.in_dir)
+        while len(stack) > 0:
+            dir_path = stack.pop()
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen.add(dir_path)
+            if self.dir_mtime.get(dir_path) != mtime:
+                self.dir_mtime[dir_path] = mtime
+                subdirs = []
+                has_sidecar = False
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        if entry.is_dir() and not entry.is_symlink():  # same as os.walk
+                            subdirs.append(entry.path)
+                        elif entry.name.endswith(sidecar_ext):
+                            has_sidecar = True
+                self.dir_subdirs[dir_path] = subdirs
+                if has_sidecar or dir_path in self.done:
+                    modified.append(dir_path)
+            stack.extend(self.dir_subdirs[dir_path])
+
+        # forget directories that disappeared
+        for dir_path in list(self.dir_mtime.keys()):
+            if dir_path not in seen:
+                del self.dir_mtime[dir_path]
+                del self.dir_subdirs[dir_path]
+                self.pending.pop(dir_path, None)
+
+        # new candidates : the last change is the most recent file, so old sessions are ready right away
+        for dir_path in modified:
+            if dir_path not in self.pending:
+                signature = self.get_signature(dir_path)
+                last_change = max([elem[2] for elem in signature], default=0) / 1e9
+                self.pending[dir_path] = (signature, min(now, last_change))
+
+        # quiescence : only the pending directories have their files stat-ed
+        ready = {}
+        for dir_path, (signature, last_change) in list(self.pending.items()):
+            new_signature = self.get_signature(dir_path)
+            if new_signature != signature:
+                self.pending[dir_path] = (new_signature, now)  # still changing
+            elif now - last_change >= self.quiescence:
+                del self.pending[dir_path]
+                if len(signature) > 0 and signature != self.done.get(dir_path):
+                    ready[dir_path] = signature
+
+        return ready
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def process(self, ready: Dict[str, frozenset]) -> None:
+
+        log = get_logger()
+
+        # load the new sessions
+        new_volumes = []
+        for dir_path, signature in sorted(ready.items()):
+            log.info(f"session ready : {dir_path}")
+
+            file_list = sorted(os.path.join(dir_path, name) for name, _, _ in signature)
+            file_list_nii = [file for file in file_list if file.endswith(('.nii', '.nii.gz'))]
+            file_list_nii, _ = utils.check_if_json_exists(file_list_nii)
+            volumes = [Volume(file) for file in file_list_nii]
+            utils.read_all_json(volumes)
+
+            self.volumes[dir_path] = volumes
+            self.done[dir_path] = signature
+            new_volumes += volumes
+
+        # run numbers and ses numbers are computed per subject, so all the volumes of each subject are classified again
+        # the .json are already in memory, they are not read again
+        subjects = {volume.seqparam.get('PatientName') for volume in new_volumes}
+        for volume in new_volumes:
+            self.subject_dirs.setdefault(volume.seqparam.get('PatientName'), set()).add(os.path.dirname(volume.nii.path))
+        subject_volumes = []
+        for sub_name in subjects:
+            for dir_path in sorted(self.subject_dirs[sub_name]):
+                subject_volumes += [volume for volume in self.volumes[dir_path]
+                                    if volume.seqparam.get('PatientName') == sub_name]
+        if len(subject_volumes) == 0:
+            return
+
+        # previous volumes are already written on disk : they should keep the same name
+        new_volumes_set = set(new_volumes)
+        old_path = {}
+        for volume in subject_volumes:
+            if volume not in new_volumes_set and len(volume.tag) > 0:
+                old_path[volume] = get_bids_path(self.out_dir, volume)
+
+        for volume in subject_volumes:
+            volume.reset_bids()
+        import niix2bids.decision_tree.siemens  # lazy import : pandas is only imported when the decision tree is used
+        niix2bids.decision_tree.siemens.run(subject_volumes, self.config)
+
+        changed = {}
+        for volume, path in old_path.items():
+            if get_bids_path(self.out_dir, volume) != path:
+                sub_name = volume.seqparam.get('PatientName')
+                changed[sub_name] = changed.get(sub_name, 0) + 1
+
+        # the new volumes of these subjects would mix with the old names, so do not write them
+        for sub_name, count in changed.items():
+            log.error(f"new session of PatientName = {sub_name} changes the name of {count} already written volumes "
+                      f"(ses/run numbering) : not written, run niix2bids without watch mode to rebuild this subject")
+        new_volumes = [volume for volume in new_volumes if volume.seqparam.get('PatientName') not in changed]
+
+        # only write the new sessions, their rows are appended to the report of the previous cycles
+        report = Report(get_report_file(self.out_dir), append=True)
+        journal = Journal(get_journal_file(self.out_dir))
+        try:
+            utils.apply_bids_architecture(self.out_dir, new_volumes, self.symlink_or_copyfile, report,
+                                          destinations=self.destinations, journal=journal)
+        finally:
+            report.close()
+            journal.close()
+
+        # the rows of the new sessions are added to the catalog of the previous cycles : the whole file is written again
+        if self.catalog and len(new_volumes) > 0:
+            import niix2bids.catalog
+            catalog_file = niix2bids.catalog.get_catalog_file(self.out_dir)
+            part_file = niix2bids.catalog.get_part_file(catalog_file, 0)
+            niix2bids.catalog.write_part(part_file, self.out_dir, new_volumes)
+            try:
+                niix2bids.catalog.write_catalog(catalog_file, [part_file], update=True)
+            finally:
+                os.remove(part_file)
+
+
+########################################################################################################################
+def get_bids_path(out_dir: str, vol: Volume) -> str:
+    return os.path.join(utils.get_bids_dir_path(out_dir, vol), utils.assemble_bids_name(vol))
+
+
+########################################################################################################################
+def run(watcher: Watcher, interval: float) -> None:
+
+    log = get_logger()
+
+    log.info(f"watching {len(watcher.in_dir)} directories, every {interval}s. Press Ctrl+C to stop.")
+
+    try:
+        while True:
+            try:
+                watcher.load_config()
+            except Niix2bidsError:
+                log.error(f"keep using the previous config")  # the error is already logged
+            ready = watcher.scan()
+            if len(ready) > 0:
+                try:
+                    watcher.process(ready)
+                except Niix2bidsError:
+                    log.error(f"these sessions are skipped until they are modified : {sorted(ready.keys())}")
+                log.info(f"waiting for new sessions...")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        log.info(f"watch stopped")
@@ -3,13 +3,259 @@ import argparse  # just for function signature
 import os        # for path management
 import sys       # to stop script execution on case of error
 import time      # to time execution of code
+import gc        # to release the memory between chunks
+import functools # to build the subject directory filter
+import glob      # to find the shard catalogs
+from typing import List, Tuple, Union  # for function signature
 
 # dependency modules
 
 # local modules
-import niix2bids.decision_tree.siemens
-from niix2bids import utils, metadata
+from niix2bids import utils, metadata, watch, archive, profiling, progress, dicom
 from niix2bids.utils import get_logger
+from niix2bids.classes import ConversionResult, Niix2bidsError
+from niix2bids.report import Report, get_report_file
+from niix2bids.journal import Journal, get_journal_file
+from niix2bids.header_cache import HeaderCache, get_cache_file
+
+
+########################################################################################################################
+def convert(in_dir: Union[str, List[str]], out_dir: str, config=None, symlink_or_copyfile: str = 'symlink',
+            shard: Tuple[int, int] = None, update: bool = False, checksum: bool = False, transcode: str = None,
+            compress_level: int = 6, out_tar: str = None, keep_duplicates: bool = False, chunk_subjects: int = None,
+            max_memory: int = None, header_cache: Union[bool, str] = True, from_dicom: bool = False,
+            dcm2niix: str = 'dcm2niix', dcm2niix_flags: str = dicom.default_flags,
+            dcm2niix_jobs: int = None, include_subject: List[str] = None, exclude_subject: List[str] = None,
+            include_session: List[str] = None, subject_dirs: bool = False,
+            catalog: bool = False, profile: str = None, progress_renderer=None,
+            progress_interval: float = progress.default_interval) -> ConversionResult:
+    """
+    Library entry point : no sys.exit(), no global state, so it can be called several times in the same process,
+    also at the same time from several threads.
+    config can be None (default locations), the path of a config file, or the config list itself.
+    update : rewrite the files of out_dir whose source changed (size, mtime, symlink target), instead of skipping them.
+    checksum : with update, compare the content hash of copied files with same size but different mtime.
+    transcode : None (keep the source extension), 'compress' (.nii.gz) or 'decompress' (.nii), with zlib compress_level.
+    out_tar : write the BIDS tree in this tar file ('-' for stdout, .tar.gz for compressed) instead of out_dir.
+    keep_duplicates : do not remove the duplicate series (same sidecar identity and same content).
+    chunk_subjects, max_memory : process the subjects by chunks of N subjects, or of ~max_memory bytes.
+        The memory is released between chunks, so result.volumes and result.duplicates stay empty.
+    header_cache : True (out_dir/niix2bids_header_cache.sqlite), False (disabled), or the path of the cache file.
+        The nifti headers read by the decision tree are kept in this file, for the next runs.
+    from_dicom : in_dir contains DICOM series, converted first by dcm2niix (executable name or path) with
+        dcm2niix_flags, dcm2niix_jobs at a time, in out_dir/sourcedata/dcm2niix.
+    include_subject, exclude_subject : shell-style patterns (fnmatch) on PatientName, or on the BIDS name sub-<label>.
+        The other subjects are dropped before the .json are loaded, with a quick read of PatientName only.
+    subject_dirs : the directories directly in in_dir are named after the subjects : the subject patterns are tested
+        on these names instead of PatientName, and the rejected directories are not even explored.
+    include_session : patterns on the session number (2, ses-2) or on StudyInstanceUID. Applied after the decision
+        tree, which needs all the sessions of a subject to number them.
+        With any of these filters, the report is written in niix2bids_report_subset.tsv.
+    catalog : write out_dir/niix2bids_catalog.parquet, 1 row per volume with all the sidecar fields and the
+        classification, for cohort queries. Needs pyarrow. A run with subject or session filters only replaces the rows
+        of its volumes.
+    profile : None, 'cpu' or 'memory', results in out_dir/niix2bids_profile. Only 1 call of the process at a time.
+    progress_renderer : progress of the long stages, None (disabled), 'log', 'tty' or a function, which receives a
+        niix2bids.progress.Event at most every progress_interval seconds.
+    Raise Niix2bidsError in case of error.
+    """
+
+    log = get_logger()
+
+    # force single str to be list, for easier management
+    if isinstance(in_dir, str):
+        in_dir = [in_dir]
+    in_dir = [os.path.abspath(one_dir) for one_dir in in_dir]
+    out_dir = os.path.abspath(out_dir)
+
+    result = ConversionResult(out_dir)
+
+    # progress and profiling of this call only : several calls can run at the same time in the process
+    with profiling.scope(profile, out_dir), progress.scope(progress_renderer, progress_interval):
+
+        def timeit(stage: str, func, *args):
+            start_time = time.time()
+            with profiling.stage(stage):
+                res = func(*args)
+            result.timings[stage] = result.timings.get(stage, 0) + time.time() - start_time  # summed over chunks
+            return res
+
+        # check if input dir exists
+        for one_dir in in_dir:
+            if not os.path.exists(one_dir):
+                log.error(f"in_dir does not exist : {one_dir}")
+                raise Niix2bidsError(f"in_dir does not exist : {one_dir}")
+        os.makedirs(out_dir, exist_ok=True)
+
+        # the subjects are only known after the conversion : each shard would convert everything
+        if from_dicom and shard is not None:
+            log.error(f"from_dicom cannot be used with shard")
+            raise Niix2bidsError(f"from_dicom cannot be used with shard")
+
+        # the tar header needs the size of each file before its content :
+        # no transcoding, and nothing to update in a stream
+        if out_tar is not None and (update or transcode is not None):
+            log.error(f"out_tar cannot be used with update or transcode")
+            raise Niix2bidsError(f"out_tar cannot be used with update or transcode")
+        output = archive.TarWriter(out_tar, out_dir) if out_tar is not None else None
+
+        # check the optional dependency before the conversion
+        if catalog:
+            import niix2bids.catalog  # lazy import : pandas is only imported when needed
+            niix2bids.catalog.check_engine()
+            if shard is not None:
+                catalog_file = niix2bids.catalog.get_shard_catalog_file(out_dir, shard)
+            else:
+                catalog_file = niix2bids.catalog.get_catalog_file(out_dir)
+
+        # load config file
+        if config is None:
+            config = utils.load_config_file(utils.get_default_config_file())
+        elif isinstance(config, str):
+            config = utils.load_config_file(config)
+
+        # subject selection : on the directory names during the exploration when the layout allows it,
+        # else on PatientName
+        subset = bool(include_subject or exclude_subject or include_session)
+        dir_filter = None
+        if subject_dirs and (include_subject or exclude_subject):
+            dir_filter = functools.partial(utils.match_subject, include=include_subject, exclude=exclude_subject)
+
+        # read all dirs and establish file list
+        if from_dicom:
+            # the files written by dcm2niix are already known, no need to explore them
+            file_list = timeit('convert_dicom', dicom.convert_all, in_dir, out_dir, dcm2niix, dcm2niix_flags,
+                               dcm2niix_jobs, dir_filter)
+        else:
+            file_list = timeit('fetch_all_files', utils.fetch_all_files, in_dir, dir_filter)
+
+        # isolate .nii files
+        file_list_nii = timeit('isolate_nii_files', utils.isolate_nii_files, file_list)
+
+        # check if all .nii files have their own .json
+        file_list_nii, file_list_json = timeit('check_if_json_exists', utils.check_if_json_exists, file_list_nii)
+
+        # create Volume objects, with the header cache of this call : several calls in the same process do not share it
+        cache = None
+        if header_cache:
+            cache = HeaderCache(get_cache_file(out_dir) if header_cache is True else header_cache)
+        volume_list = timeit('create_volume_list', utils.create_volume_list, file_list_nii, cache)
+
+        # only keep the selected subjects
+        if dir_filter is None and (include_subject or exclude_subject):
+            timeit('filter_subjects', utils.filter_subjects, volume_list, include_subject, exclude_subject)
+        if subset and len(volume_list) == 0:  # most likely a typo in a pattern
+            log.error(f"no nifti file left by the subject filters")
+            raise Niix2bidsError(f"no nifti file left by the subject filters")
+
+        # only keep the subjects of this shard
+        if shard is not None:
+            timeit('filter_shard', utils.filter_shard, volume_list, shard)
+            result.report_file = utils.get_shard_report_file(out_dir, shard)
+            if len(volume_list) == 0:  # possible with few subjects and many shards
+                log.warning(f"no subject in {utils.get_shard_name(shard)}, nothing to do")
+                Report(result.report_file).close()  # empty report, so the merge step knows this shard is done
+                if output is not None:
+                    output.close()
+                return result
+        elif subset:
+            result.report_file = get_report_file(out_dir, '_subset')  # keep the report of the whole dataset
+        else:
+            result.report_file = get_report_file(out_dir)
+
+        # big cohorts : load -> classify -> write, for a few subjects at a time
+        chunked = chunk_subjects is not None or max_memory is not None
+        if chunked:
+            chunks = timeit('split_subject_chunks', utils.split_subject_chunks, volume_list, chunk_subjects, max_memory)
+            volume_list = None  # the chunks are the only owners of the volumes, so each one can be released
+        else:
+            chunks = [volume_list]
+
+        report = Report(result.report_file)
+        catalog_parts = []  # 1 parquet file per chunk, combined at the end
+        destinations = {}  # collisions are also checked between chunks
+        journal = None     # files completely written : an interrupted run can be resumed without checking them again
+        if output is None:
+            journal = Journal(get_journal_file(out_dir, '' if shard is None else f"_{utils.get_shard_name(shard)}"))
+        try:
+            for idx in range(len(chunks)):
+                chunk = chunks[idx]
+                chunks[idx] = None
+                if chunked:
+                    log.info(f"chunk {idx+1}/{len(chunks)} : {len(chunk)} nifti files")
+
+                # read all json files
+                timeit('read_all_json', utils.read_all_json, chunk)
+
+                # the same series exported twice would get 2 run numbers, and would be written twice
+                duplicates = []
+                if not keep_duplicates:
+                    duplicates = timeit('remove_duplicates', utils.remove_duplicates, chunk)
+                for volume, canonical in duplicates:
+                    report.add(volume.nii.path, '', '', '', 'duplicate', f"duplicate of {canonical.nii.path}")
+
+                # apply decision tree
+                # !! here, only Siemens is implemented !!
+                # lazy import : pandas is only imported when the decision tree is used
+                import niix2bids.decision_tree.siemens
+                timeit('decision_tree', niix2bids.decision_tree.siemens.run, chunk, config)
+
+                # only keep the selected sessions
+                if include_session:
+                    timeit('filter_sessions', utils.filter_sessions, chunk, include_session)
+
+                # perform files operations
+                timeit('apply_bids_architecture', utils.apply_bids_architecture,
+                       out_dir, chunk, symlink_or_copyfile, report, update, checksum, transcode, compress_level, output,
+                       destinations, journal)
+                result.assignments += [utils.get_volume_assignment(out_dir, vol, transcode) for vol in chunk]
+                if catalog:
+                    catalog_parts.append(niix2bids.catalog.get_part_file(catalog_file, idx))
+                    timeit('catalog', niix2bids.catalog.write_part, catalog_parts[-1], out_dir, chunk, transcode,
+                           duplicates)
+
+                # in chunked mode, only the assignments are kept :
+                # the volumes, their .json and the DataFrame are released
+                if not chunked:
+                    result.volumes = chunk
+                    result.duplicates = duplicates
+                del chunk, duplicates
+                gc.collect()  # Volume <-> seqparam['Volume'] is a reference cycle
+
+        finally:
+            report.close()
+            if journal is not None:
+                journal.close()
+            if cache is not None:
+                log.info(f"header cache : {cache.hits} hits, {cache.misses} headers read")
+                cache.close()
+
+        # 1 row per volume, with all the sidecar fields : cohort queries without reading the .json again
+        if catalog:
+            try:
+                timeit('write_catalog', niix2bids.catalog.write_catalog, catalog_file, catalog_parts, subset)
+            finally:
+                for part in catalog_parts:
+                    os.remove(part)
+
+        if shard is None:
+
+            # write dataset_description.json
+            timeit('write_bids_dataset_description', utils.write_bids_dataset_description, out_dir, output)
+
+            # write other files
+            timeit('write_bids_other_files', utils.write_bids_other_files, out_dir, output)
+
+        else:
+            # shards only write their own subjects, the dataset files are written once by the merge step
+            log.info(f"when all shards are done, run : niix2bids merge -o {out_dir}")
+
+        # all entries are known : stream the tar
+        if output is not None:
+            written = timeit('write_tar', output.close)
+            log.info(f"tar : {len(output.entries)} entries, {utils.format_bytes(written)} -> {out_tar}")
+
+        return result
 
 
 ########################################################################################################################
@@ -25,39 +271,76 @@ def run(args: argparse.Namespace) -> None:
     log.info(f"in_dir  : {args.in_dir}")
     log.info(f"out_dir : {args.out_dir}")
     if args.logfile:
-        log.info(f"logfile : {log.__class__.root.handlers[1].baseFilename}")
+        log.info(f"logfile : {utils.get_logfile()}")
     log.info(f"out_dir write method = {args.symlink_or_copyfile}")
+    if args.out_tar is not None:
+        log.info(f"out_tar : {args.out_tar}")
+    if args.chunk_subjects is not None or args.max_memory is not None:
+        log.info(f"chunks  : {args.chunk_subjects} subjects, {args.max_memory} bytes")
+    if args.shard is not None:
+        log.info(f"shard   : {utils.get_shard_name(args.shard)}")
+    if args.update or args.checksum:
+        log.info(f"update mode" + (" with checksum" if args.checksum else ""))
+    if args.include_subject or args.exclude_subject or args.include_session:
+        log.info(f"subjects : include {args.include_subject}, exclude {args.exclude_subject}" +
+                 (", on the directory names" if args.subject_dirs else "") +
+                 f", sessions : include {args.include_session}")
+    if args.from_dicom:
+        log.info(f"from DICOM : {args.dcm2niix} {args.dcm2niix_flags}, in {dicom.get_nifti_dir(args.out_dir)}")
+    if args.transcode is not None:
+        log.info(f"nifti transcoding : {args.transcode}" +
+                 (f", level {args.compress_level}" if args.transcode == 'compress' else ""))
+    if args.profile is not None:
+        log.info(f"profile : {args.profile}, in {profiling.get_profile_dir(args.out_dir)}")
 
-    # check if input dir exists
-    for one_dir in args.in_dir:
-        if not os.path.exists(one_dir):
-            log.error(f"in_dir does not exist : {one_dir}")
-            sys.exit(1)
+    try:
+        config = utils.load_config_file(args.config_file)
+        convert(args.in_dir, args.out_dir, config, args.symlink_or_copyfile, args.shard,
+                args.update or args.checksum, args.checksum, args.transcode, args.compress_level, args.out_tar,
+                args.keep_duplicates, args.chunk_subjects, args.max_memory, args.header_cache, args.from_dicom,
+                args.dcm2niix, args.dcm2niix_flags, args.dcm2niix_jobs, args.include_subject, args.exclude_subject,
+                args.include_session, args.subject_dirs, args.catalog, args.profile, args.progress,
+                args.progress_interval)
+    except Niix2bidsError:
+        sys.exit(1)  # the error is already logged
 
-    # load config file
-    config = utils.load_config_file(args.config_file)
+    stop_time = time.time()
 
-    # read all dirs and establish file list
-    file_list = utils.fetch_all_files(args.in_dir)
+    log.info(f'Total execution time is : {stop_time-star_time:.3f}s')
 
-    # isolate .nii files
-    file_list_nii = utils.isolate_nii_files(file_list)
+    # THE END
+    sys.exit(0)
 
-    # check if all .nii files have their own .json
-    file_list_nii, file_list_json = utils.check_if_json_exists(file_list_nii)
 
-    # create Volume objects
-    volume_list = utils.create_volume_list(file_list_nii)
+########################################################################################################################
+def run_merge(args: argparse.Namespace) -> None:
 
-    # read all json files
-    utils.read_all_json(volume_list)
+    star_time = time.time()
 
-    # apply decision tree
-    # !! here, only Siemens is implemented !!
-    niix2bids.decision_tree.siemens.run(volume_list, config)
+    # start logging stuff
+    log = get_logger()
+    log.info(f"niix2bids=={metadata.get_niix2bids_version()}")
 
-    # perform files operations
-    utils.apply_bids_architecture(args.out_dir, volume_list, args.symlink_or_copyfile)
+    # logs
+    log.info(f"out_dir : {args.out_dir}")
+    if args.logfile:
+        log.info(f"logfile : {utils.get_logfile()}")
+
+    # check if out_dir exists
+    if not os.path.exists(args.out_dir):
+        log.error(f"out_dir does not exist : {args.out_dir}")
+        sys.exit(1)
+
+    # combine the report of each shard
+    utils.merge_shard_reports(args.out_dir)
+
+    # combine the catalog of each shard, if they have one : pandas is only imported in this case
+    if len(glob.glob(utils.get_catalog_file(args.out_dir, '_shard-*of*'))) > 0:
+        import niix2bids.catalog
+        try:
+            niix2bids.catalog.merge_shard_catalogs(args.out_dir)
+        except Niix2bidsError:
+            sys.exit(1)  # the error is already logged
 
     # write dataset_description.json
     utils.write_bids_dataset_description(args.out_dir)
@@ -71,3 +354,41 @@ def run(args: argparse.Namespace) -> None:
 
     # THE END
     sys.exit(0)
+
+
+########################################################################################################################
+def run_watch(args: argparse.Namespace) -> None:
+
+    # start logging stuff
+    log = get_logger()
+    log.info(f"niix2bids=={metadata.get_niix2bids_version()}")
+
+    # logs
+    log.info(f"in_dir  : {args.in_dir}")
+    log.info(f"out_dir : {args.out_dir}")
+    if args.logfile:
+        log.info(f"logfile : {utils.get_logfile()}")
+    log.info(f"out_dir write method = {args.symlink_or_copyfile}")
+    log.info(f"quiescence = {args.quiescence}s")
+
+    # check if input dir exists
+    for one_dir in args.in_dir:
+        if not os.path.exists(one_dir):
+            log.error(f"in_dir does not exist : {one_dir}")
+            sys.exit(1)
+
+    # the dataset files do not depend on the sessions, write them once
+    utils.write_bids_dataset_description(args.out_dir)
+    utils.write_bids_other_files(args.out_dir)
+
+    # poll in_dir until Ctrl+C
+    try:
+        watcher = watch.Watcher(args.in_dir, args.out_dir, args.symlink_or_copyfile, args.config_file, args.quiescence,
+                                args.catalog)
+    except Niix2bidsError:
+        sys.exit(1)  # the error is already logged
+    with progress.scope(args.progress, args.progress_interval):
+        watch.run(watcher, args.interval)
+
+    # THE END
+    sys.exit(0)
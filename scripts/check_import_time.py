@@ -0,0 +1,83 @@
+"""
+Check the import-time budget of the command line : pandas, numpy and nibabel must only be imported by the stages
+that use them, so `niix2bids --version`, `--help`, argument errors and `niix2bids merge` stay fast.
+
+Usage : python scripts/check_import_time.py [BUDGET_MS]
+Exit code 0 if the budget is respected, 1 otherwise.
+"""
+
+# standard modules
+import os          # for path management
+import sys         # for the exit code and the interpreter
+import subprocess  # python -X importtime, in a fresh interpreter
+import tempfile    # out_dir of the merge check
+from typing import Dict  # for function signature
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+budget_ms = 300                                   # cumulative import time of niix2bids.cli, ~100 ms measured
+forbidden = ['pandas', 'numpy', 'nibabel', 'pyarrow']
+runs      = 3                                     # the best run is kept, the first one can pay for a cold disk cache
+
+
+########################################################################################################################
+def get_import_times(code: str) -> Dict[str, int]:
+    # module -> cumulative import time in microseconds, from the stderr of python -X importtime
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=repo_dir,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"import failed :\n{res.stderr}")
+    times = {}
+    for line in res.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+########################################################################################################################
+def get_forbidden(times: Dict[str, int]) -> list:
+    return sorted(name for name in times if name.split('.')[0] in forbidden)
+
+
+########################################################################################################################
+def main(budget: float) -> int:
+
+    ok = True
+
+    # import of the command line
+    best = None
+    for _ in range(runs):
+        times = get_import_times('import niix2bids.cli')
+        bad = get_forbidden(times)
+        if len(bad) > 0:
+            print(f"import niix2bids.cli : imports {bad}")
+            ok = False
+            break
+        best = times['niix2bids.cli'] if best is None else min(best, times['niix2bids.cli'])
+    if best is not None:
+        print(f"import niix2bids.cli : {best / 1000:.0f} ms (budget {budget:.0f} ms)")
+        ok &= best / 1000 <= budget
+
+    # merge step, without shard catalog : the dataset files and the report only
+    with tempfile.TemporaryDirectory() as out_dir:
+        with open(os.path.join(out_dir, 'niix2bids_report_shard-1of1.tsv'), 'w') as fp:
+            fp.write('in_path\tout_path\ttag\tsuffix\tstatus\treason\n')
+        code = ("import sys\n"
+                "from niix2bids.cli import main\n"
+                f"sys.argv = ['niix2bids', 'merge', '-o', {out_dir!r}, '--no-logfile']\n"
+                "try:\n"
+                "    main()\n"
+                "except SystemExit:\n"
+                "    pass\n")
+        bad = get_forbidden(get_import_times(code))
+        print(f"niix2bids merge : " + (f"imports {bad}" if len(bad) > 0 else "no heavy import"))
+        ok &= len(bad) == 0
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) > 1 else budget_ms))
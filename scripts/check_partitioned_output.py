@@ -0,0 +1,78 @@
+"""
+Check that processing the subjects by chunks, or by shards, gives the same BIDS tree as processing them all at once.
+The names (ses, run numbers) must only depend on the volumes of each subject.
+
+Usage : python scripts/check_partitioned_output.py IN_DIR [IN_DIR ...]
+Exit code 0 if the trees are identical, 1 otherwise.
+"""
+
+# standard modules
+import os        # for path management
+import sys       # for the exit code
+import logging   # to keep the console quiet
+import tempfile  # the trees are written in a temporary directory
+from typing import List, Dict  # for function signature
+
+# local modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from niix2bids.workflow import convert
+
+
+shard_count = 3
+
+
+########################################################################################################################
+def get_tree(out_dir: str) -> Dict[str, str]:
+    # relative path -> symlink target, for the files of the sub-directories (sub-*, DISCARD, ...)
+    # the dataset files, the report and the logs are not compared
+    tree = {}
+    for root, dirs, files in os.walk(out_dir):
+        if root == out_dir:
+            continue
+        for file in files:
+            path = os.path.join(root, file)
+            tree[os.path.relpath(path, out_dir)] = os.readlink(path) if os.path.islink(path) else ''
+    return tree
+
+
+########################################################################################################################
+def compare(name: str, reference: Dict[str, str], tree: Dict[str, str]) -> bool:
+    missing = sorted(set(reference) - set(tree))
+    extra   = sorted(set(tree) - set(reference))
+    changed = sorted(path for path in set(reference) & set(tree) if reference[path] != tree[path])
+    for label, paths in [('missing', missing), ('extra', extra), ('other target', changed)]:
+        for path in paths[:10]:
+            print(f"{name} : {label} : {path}")
+    same = len(missing) == 0 and len(extra) == 0 and len(changed) == 0
+    print(f"{name} : {'same' if same else 'DIFFERENT'} ({len(tree)} files)")
+    return same
+
+
+########################################################################################################################
+def main(in_dir: List[str]) -> int:
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        reference_dir = os.path.join(tmp_dir, 'all')
+        convert(in_dir, reference_dir, header_cache=False)
+        reference = get_tree(reference_dir)
+
+        chunked_dir = os.path.join(tmp_dir, 'chunked')
+        convert(in_dir, chunked_dir, header_cache=False, chunk_subjects=1)
+        same = compare('--chunk-subjects 1', reference, get_tree(chunked_dir))
+
+        sharded_dir = os.path.join(tmp_dir, 'sharded')
+        for index in range(1, shard_count + 1):
+            convert(in_dir, sharded_dir, header_cache=False, shard=(index, shard_count))
+        same &= compare(f"--shard 1..{shard_count}/{shard_count}", reference, get_tree(sharded_dir))
+
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    sys.exit(main(sys.argv[1:]))
@@ -23,6 +23,9 @@ setuptools.setup(
         "pandas",
         "nibabel",
     ],
+    extras_require={
+        'catalog': ["pyarrow"],  # --catalog, parquet file
+    },
     entry_points={
         'console_scripts': [
             'niix2bids = niix2bids.cli:main'